@@ -15,9 +15,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import sys, os, re, argparse, copy, configparser
+import sys, os, io, re, argparse, copy, configparser, hashlib, json, sqlite3, threading, asyncio, concurrent.futures
+import collections, gc, pickle, random, struct, time, zipfile, zlib
 
-from PIL import Image
+from PIL import Image, ImageMath, PngImagePlugin
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
 
 
 class ShaderGenerator(dict):
@@ -49,14 +55,33 @@ class ShaderGenerator(dict):
 	# basename of the per-set option file
 	defaultSlothFile = "options"+slothFileExt
 
+	# size of the blocks sampled when computing a cheap content key for a map
+	mapSampleSize    = 64 * 1024
+
 
 	def __init__(self, verbosity = 0):
 		self.verbosity        = verbosity
 		self.sets             = dict() # set name -> shader name -> key -> value
 		self.header           = ""     # header to be prepended to output
+		self.renderedHeader   = ("", "") # header -> header as comment lines
+		self.renderCache      = dict() # (set name, shader name, renderer, compact) -> (shader, rendered definition)
+		self.compactOutput    = False  # whether to write shaders with minimal whitespace and without redundant variants
 		self.suffixes         = dict() # map type -> suffix
+		self.mapCache         = dict() # content key -> list of analysed maps with that key, see __findMapEntry
+		self.mapKeys          = dict() # map path -> ((size, mtime), content key, full content hash or None)
+		self.mapCacheLock     = threading.Lock()
+		self.optionsLock      = threading.Lock() # held while changing or copying the default options
+		self.setsLock         = threading.Lock() # held while replacing a set with an extended one
+		self.keywordMatcher   = KeywordMatcher() # finds words in shader names that trigger guessed keywords
+		self.analysisRows     = None   # height of the strips maps are analysed in, None to analyse them as a whole
+		self.analysisError    = None   # error allowed for approximate average colors, None for exact analysis
+		self.shard            = None   # (index, count) of the part of the shaders to generate, None for all
 		self.setSuffixes()
 
+		for surfaceParm, words in self.surfaceParms.items():
+			for word in words:
+				self.keywordMatcher.add(word, ("surfaceparm", surfaceParm))
+
 		# default options that can be overwritten on a per-directory/shader basis
 		self["options"]                     = dict()
 		self["options"]["lightColors"]      = dict() # color name -> RGB color triple
@@ -101,19 +126,82 @@ class ShaderGenerator(dict):
 		self.header = text
 
 
+	def setCompactOutput(self, value = True):
+		"Write shaders with minimal whitespace and without comments other than the header. Light variants whose "
+		"definition is identical to that of another variant of the same texture are left out."
+		self.compactOutput = value
+
+
 	def setSuffixes(self, diffuse = "_d", normal = "_n", height = "_h", specular = "_s", addition = "_a", preview = "_p"):
 		"Sets the filename suffixes for the different texture map types."
-		self.suffixes["diffuse"]  = diffuse
-		self.suffixes["normal"]   = normal
-		self.suffixes["height"]   = height
-		self.suffixes["specular"] = specular
-		self.suffixes["addition"] = addition
-		self.suffixes["preview"]  = preview
+		suffixes = dict()
+
+		suffixes["diffuse"]  = diffuse
+		suffixes["normal"]   = normal
+		suffixes["height"]   = height
+		suffixes["specular"] = specular
+		suffixes["addition"] = addition
+		suffixes["preview"]  = preview
+
+		# replace rather than modify, sets being generated keep using the old suffixes
+		self.suffixes = suffixes
+
+
+	def setTiledAnalysis(self, rows):
+		"Analyse maps in horizontal strips of the given height to bound memory usage, or as a whole if rows is None. "
+		"The peak memory used for each map is reported in verbose mode."
+		self.analysisRows = rows
+
+
+	def setApproximateAnalysis(self, error):
+		"Allow average colors of uncompressed addition maps to be calculated from a random sample of their rows if "
+		"the error is at most error with high confidence. Other metadata is retrieved exactly but may use a sample to "
+		"finish early. None disables sampling."
+		self.analysisError = error
+
+
+	def setShard(self, index, count):
+		"Only generate shaders that fall into part index of count parts, so that their maps can be analysed on "
+		"multiple machines. The parts are combined with saveShard and mergeShards. Returns whether the part exists."
+		if not 0 <= index < count:
+			self.error("Shard "+str(index)+" out of range for "+str(count)+" shards.")
+			return False
+
+		self.shard = (index, count)
+
+		return True
 
 
 	def readConfig(self, fp):
 		self.debug("Parsing global options file...")
-		self.__parseSlothFile(self, fp)
+
+		with self.optionsLock:
+			self.__parseSlothFile(self, fp)
+
+
+	def readKeywordDictionary(self, fp):
+		"Reads words that trigger keywords when keyword guessing is enabled. Every section names a keyword and contains "
+		"values for it, each followed by the words that trigger it, e.g. \"[surfaceparm]\\nmetalsteps = metal steel\"."
+		config = configparser.ConfigParser(allow_no_value = True, interpolation = None)
+
+		# be case sensitive
+		config.optionxform = lambda option: option
+
+		try:
+			config.read_string(fp.read())
+		except (configparser.ParsingError, configparser.DuplicateOptionError) as error:
+			self.error(str(error))
+			return
+
+		numWords = 0
+
+		for section in config.sections():
+			for value, words in config[section].items():
+				for word in (words or "").split():
+					self.keywordMatcher.add(word, (section, value))
+					numWords += 1
+
+		self.verbose("Read "+str(numWords)+" words for keyword guessing.")
 
 
 	######################
@@ -129,7 +217,8 @@ class ShaderGenerator(dict):
 
 	def setKeywordGuessing(self, value = True):
 		"Whether to try to guess additional keywords based on shader (meta)data"
-		self.__setKeywordGuessing(value)
+		with self.optionsLock:
+			self.__setKeywordGuessing(value)
 
 
 	def __setRadToAddExponent(self, value, shader = None):
@@ -140,7 +229,8 @@ class ShaderGenerator(dict):
 
 	def setRadToAddExponent(self, value):
 		"Set the exponent used to convert radiosity RGB values into addition map color modifiers"
-		self.__setRadToAddExponent(value)
+		with self.optionsLock:
+			self.__setRadToAddExponent(value)
 
 
 	def __setHeightNormalsMod(self, value, shader = None):
@@ -151,7 +241,8 @@ class ShaderGenerator(dict):
 
 	def setHeightNormalsMod(self, value):
 		"Set the modifier used when generating normals from height maps"
-		self.__setHeightNormalsMod(value)
+		with self.optionsLock:
+			self.__setHeightNormalsMod(value)
 
 
 	def __setEditorOpacity(self, value, shader = None):
@@ -165,7 +256,8 @@ class ShaderGenerator(dict):
 
 	def setEditorOpacity(self, value):
 			"Set the in-editor opacity of transparent shaders"
-			self.__setEditorOpacity(value)
+			with self.optionsLock:
+				self.__setEditorOpacity(value)
 
 
 	def __setAlphaTest(self, test, shader = None):
@@ -184,7 +276,8 @@ class ShaderGenerator(dict):
 
 	def setAlphaTest(self, test):
 		"Set the alpha test method used, blend smoothly if None."
-		self.__setAlphaTest(test)
+		with self.optionsLock:
+			self.__setAlphaTest(test)
 
 
 	def __setAlphaShadows(self, value, shader = None):
@@ -195,7 +288,8 @@ class ShaderGenerator(dict):
 
 	def setAlphaShadows(self, value = True):
 		"Whether to add the alphashadows surfaceparm keyword to relevant shaders"
-		self.__setAlphaShadows(value)
+		with self.optionsLock:
+			self.__setAlphaShadows(value)
 
 
 	def __addLightColor(self, name, color, shader = None):
@@ -218,7 +312,8 @@ class ShaderGenerator(dict):
 
 	def addLightColor(self, name, color):
 		"Adds a light color with a given name to be used for light emitting shaders."
-		self.__addLightColor(name, color)
+		with self.optionsLock:
+			self.__addLightColor(name, color)
 
 
 	def __addLightIntensity(self, intensity, custom, shader = None):
@@ -245,11 +340,13 @@ class ShaderGenerator(dict):
 
 	def addCustomLightIntensity(self, intensity):
 		"Adds a light intensity to be used for light emitting shaders with grayscale addition maps."
-		self.__addLightIntensity(intensity, True)
+		with self.optionsLock:
+			self.__addLightIntensity(intensity, True)
 
 	def addPredefLightIntensity(self, intensity):
 		"Adds a light intensity to be used for light emitting shaders with non-grayscale addition maps."
-		self.__addLightIntensity(intensity, False)
+		with self.optionsLock:
+			self.__addLightIntensity(intensity, False)
 
 
 	def __setPrecalcColors(self, value, shader = None):
@@ -260,7 +357,8 @@ class ShaderGenerator(dict):
 
 	def setPrecalcColors(self, value = True):
 		"Whether to precalculate light colors for light emitting shaders with predefined colors."
-		self.__setPrecalcColors(value)
+		with self.optionsLock:
+			self.__setPrecalcColors(value)
 
 
 	def __setRenderer(self, renderer, shader = None):
@@ -273,7 +371,8 @@ class ShaderGenerator(dict):
 			self.error("Renderer "+renderer+" not supported. Supported renderers are "+str(self.supportedRenderers)+".")
 
 	def setRenderer(self, renderer):
-		self.__setRenderer(renderer)
+		with self.optionsLock:
+			self.__setRenderer(renderer)
 
 
 	#################
@@ -282,8 +381,12 @@ class ShaderGenerator(dict):
 
 
 	def __copyOptions(self, source, target):
-		"Copies initial shader options."
-		target["options"] = copy.deepcopy(source["options"])
+		"Copies initial shader options. The default options are copied as a whole while no setter is running."
+		if source is self:
+			with self.optionsLock:
+				target["options"] = copy.deepcopy(source["options"])
+		else:
+			target["options"] = copy.deepcopy(source["options"])
 
 
 	def __parseSlothFile(self, shader, path):
@@ -393,68 +496,540 @@ class ShaderGenerator(dict):
 				self.error("Invalid section "+section+".")
 
 
-	def __analyzeMaps(self, shader):
-		"Retrieves metadata from a shader's maps, such as whether there's an alpha channel on the diffuse map."
-		# diffuse map
-		img = Image.open(shader["abspath"]+os.path.sep+shader["diffuse"]+shader["ext"]["diffuse"], "r")
+	def __hashFile(self, path):
+		"Returns a hash of a file's full content."
+		digest = hashlib.sha1()
+
+		with open(path, "rb") as fp:
+			for block in iter(lambda: fp.read(1024 * 1024), b""):
+				digest.update(block)
 
-		# look for transparency
-		if img.mode in ("RGBA", "LA"):
-			if img.getextrema()[-1][0] == 255:
-				self.verbose("Found completely white alpha channel in "+img.filename+".")
-				shader["meta"]["diffuseAlpha"] = False
+		return digest.hexdigest()
+
+
+	def __mapKey(self, path):
+		"Returns a cheap content key for a map file, made of its size and a hash of a few sampled blocks, as well as "
+		"its full content hash if that came at no extra cost."
+		stat = os.stat(path)
+		stat = (stat.st_size, stat.st_mtime_ns)
+
+		if path in self.mapKeys and self.mapKeys[path][0] == stat:
+			return self.mapKeys[path][1:]
+
+		size   = stat[0]
+		block  = self.mapSampleSize
+		digest = hashlib.sha1()
+
+		with open(path, "rb") as fp:
+			if size <= 4 * block:
+				digest.update(fp.read())
+				full = digest.hexdigest()
 			else:
-				shader["meta"]["diffuseAlpha"] = True
-		elif img.mode == "p" and "transparency" in img.info:
-			shader["meta"]["diffuseAlpha"] = True
+				for offset in (0, size // 3, 2 * size // 3, size - block):
+					fp.seek(offset)
+					digest.update(fp.read(block))
+				full = None
+
+		key = str(size)+":"+digest.hexdigest()
+
+		self.mapKeys[path] = (stat, key, full)
+
+		return key, full
+
+
+	def __sameContent(self, path, entry):
+		"Whether a map file has the same content as a previously analysed map."
+		stat = os.stat(path)
+		stat = [stat.st_size, stat.st_mtime_ns]
+
+		if entry["path"] == path and entry["stat"] == stat:
+			return True
+
+		# fall back to comparing full content hashes
+		if not entry["full"]:
+			try:
+				entryStat = os.stat(entry["path"])
+			except OSError:
+				return False
+
+			# the map the entry was made from has changed since, so its hash can't be used anymore
+			if [entryStat.st_size, entryStat.st_mtime_ns] != entry["stat"]:
+				return False
+
+			entry["full"] = self.__hashFile(entry["path"])
+
+		stat, key, full = self.mapKeys[path]
+
+		if not full:
+			full = self.__hashFile(path)
+			self.mapKeys[path] = (stat, key, full)
+
+		return full == entry["full"]
+
+
+	def __findMapEntry(self, path):
+		"Returns the cache entry for a map, which is shared with all maps of identical content. Creates it if necessary."
+		key, full = self.__mapKey(path)
+
+		with self.mapCacheLock:
+			for entry in self.mapCache.setdefault(key, list()):
+				if self.__sameContent(path, entry):
+					return entry
+
+			stat  = os.stat(path)
+			entry = {"path": path, "stat": [stat.st_size, stat.st_mtime_ns], "full": full, "meta": dict()}
+			self.mapCache[key].append(entry)
+
+		return entry
+
+
+	def __mapAnalyzer(self, kind):
+		"Returns the function and additional arguments used to retrieve metadata of a given kind from a map."
+		if kind == "diffuse":
+			return self.analyzeDiffuseMap, (self.analysisRows, self.analysisError)
+		elif kind == "addition":
+			return self.analyzeAdditionMap, (False, self.analysisRows, self.analysisError)
+		elif kind == "additionAverage":
+			return self.analyzeAdditionMap, (True, self.analysisRows)
+		elif kind == "additionApproxAverage":
+			return self.analyzeAdditionMap, (True, self.analysisRows, self.analysisError)
+
+
+	def __storeAnalysis(self, entry, kind, path, meta):
+		"Stores the metadata retrieved from a map in its cache entry."
+		if "peakMemory" in meta:
+			peak = meta.pop("peakMemory")
+
+			if peak != None:
+				self.verbose("Analysed "+path+" using "+"%.1f" % (peak / 2**20)+" MiB.")
+
+		entry["meta"][kind] = meta
+
+
+	def __analyzeMap(self, path, kind):
+		"Returns metadata of a given kind for a map, reusing the result for an identical map if it has been analysed "
+		"before."
+		entry = self.__findMapEntry(path)
+
+		if kind in entry["meta"]:
+			self.debug("Reusing "+kind+" metadata of "+entry["path"]+" for "+path+".")
 		else:
-			shader["meta"]["diffuseAlpha"] = False
+			analyze, args = self.__mapAnalyzer(kind)
+			self.__storeAnalysis(entry, kind, path, analyze(path, *args, log = self.verbose))
 
-		# check if transparency is binary
-		shader["meta"]["diffuseAlphaBin"] = False
-		if shader["meta"]["diffuseAlpha"]:
-			alphaSequence = img.split()[-1].tobytes()
-			if self.binaryAlphaRE.match(alphaSequence):
-				shader["meta"]["diffuseAlphaBin"] = True
+		return copy.deepcopy(entry["meta"][kind])
 
-		# addition map
-		if shader["addition"]:
-			img = Image.open(shader["abspath"]+os.path.sep+shader["addition"]+shader["ext"]["addition"], "r")
-
-			gray = ( img.mode in ("L", "LA") )
-
-			img = img.convert("RGB")
-
-			# check for RGB images with no actual non-gray color
-			if not gray:
-				colors = img.getcolors(maxcolors = 256)
-				if colors:
-					gray = True
-					for _, rgb in colors:
-						if not rgb[0] == rgb[1] == rgb[2]:
-							gray = False
-							break
-
-			shader["meta"]["additionGrayscale"] = gray
-
-			# get average color if needed
-			if shader["options"]["precalcColors"]:
-				value = channel = 0
-				average = [0, 0, 0]
-				for count in img.histogram():
-					average[channel] += count * ( value / 0xff )
-					value += 1
-					if value > 0xff:
-						average[channel] /= img.size[0] * img.size[1]
-						value = 0
-						channel += 1
-						if channel == 3:
-							break
-
-				if gray:
-					shader["meta"]["additionAverage"] = (average[0], average[0], average[0])
+
+	def loadMapCache(self, fp):
+		"Reads map metadata that has been stored with saveMapCache so that unchanged maps don't need to be analysed again."
+		try:
+			cache = json.load(fp)
+		except ValueError as error:
+			self.error("Couldn't parse map cache: "+str(error))
+			return
+
+		for entries in cache.values():
+			for entry in entries:
+				for meta in entry["meta"].values():
+					for key, value in meta.items():
+						if type(value) == list:
+							meta[key] = tuple(value)
+
+		self.mapCache.update(cache)
+
+		self.verbose("Loaded metadata for "+str(sum(len(entries) for entries in cache.values()))+" maps.")
+
+
+	def saveMapCache(self, fp):
+		"Writes the metadata of all analysed maps to a file."
+		json.dump(self.mapCache, fp)
+
+
+	# number of pixels sampled from a map for approximate analysis
+	approxSamplePixels = 256 * 256
+
+	# bytes per pixel of raw pixel formats that can be decoded in strips
+	rawModeSizes = {"L": 1, "P": 1, "LA": 2, "RGB": 3, "BGR": 3, "RGBA": 4, "BGRA": 4, "RGBX": 4, "BGRX": 4}
+
+
+	@staticmethod
+	def __rawLayout(img):
+		"Returns the offset, raw mode, row stride and orientation of an opened image whose pixels are stored "
+		"uncompressed in a single block, or None."
+		width, height = img.size
+		tile          = img.tile[0] if len(img.tile) == 1 else None
+
+		if tile and tile[0] == "raw" and tile[1] == (0, 0, width, height) and tile[3][0] in ShaderGenerator.rawModeSizes:
+			rawmode, stride, orientation = tile[3]
+
+			return tile[2], rawmode, stride or width * ShaderGenerator.rawModeSizes[rawmode], orientation
+
+
+	@staticmethod
+	def imageStrips(img, rows = None):
+		"Yields an opened image in horizontal strips of a given number of rows, or as a whole if rows is None. "
+		"Uncompressed images are read strip by strip, so only one strip needs to be held in memory at a time."
+		width, height = img.size
+
+		if not rows or rows >= height:
+			yield img
+			return
+
+		layout = ShaderGenerator.__rawLayout(img)
+
+		if layout:
+			offset, rawmode, stride, orientation = layout
+
+			for top in range(0, height, rows):
+				count = min(rows, height - top)
+				first = top if orientation >= 0 else height - top - count # first row of the strip in the file
+
+				img.fp.seek(offset + first * stride)
+				strip = Image.frombytes(img.mode, (width, count), img.fp.read(count * stride),
+				                        "raw", rawmode, stride, orientation)
+
+				if img.palette:
+					strip.putpalette(img.palette)
+
+				yield strip
+		else:
+			for top in range(0, height, rows):
+				yield img.crop((0, top, width, min(top + rows, height)))
+
+
+	@staticmethod
+	def __resetPeakMemory():
+		"Starts measuring the peak memory usage of the process. Returns the current usage in bytes, if available."
+		try:
+			with open("/proc/self/clear_refs", "w") as fp:
+				fp.write("5")
+
+			with open("/proc/self/status", "r") as fp:
+				for line in fp:
+					if line.startswith("VmRSS:"):
+						return int(line.split()[1]) * 1024
+		except OSError:
+			return None
+
+
+	@staticmethod
+	def __peakMemory(baseline):
+		"Returns the peak memory usage in bytes since __resetPeakMemory returned baseline, if available."
+		if baseline == None:
+			return None
+
+		with open("/proc/self/status", "r") as fp:
+			for line in fp:
+				if line.startswith("VmHWM:"):
+					return max(0, int(line.split()[1]) * 1024 - baseline)
+
+
+	@staticmethod
+	def sampleImage(img, step):
+		"Returns a sample of about every step-th row of an opened image. Uncompressed images are sampled by reading "
+		"randomly chosen whole rows, the same ones for every image of that size. JPEG images are decoded at a reduced "
+		"scale instead, so their pixels are averages and the opened image can't be used at full scale afterwards. "
+		"Other images are decoded and every step-th pixel of every step-th row is taken."
+		width, height = img.size
+		size          = ((width + step - 1) // step, (height + step - 1) // step)
+		layout        = ShaderGenerator.__rawLayout(img)
+
+		if img.format == "JPEG":
+			img.draft(img.mode, size)
+			img.load()
+			return img
+		elif layout:
+			offset, rawmode, stride, orientation = layout
+			data = list()
+
+			for row in sorted(random.Random(0).sample(range(height), size[1])):
+				img.fp.seek(offset + (row if orientation >= 0 else height - row - 1) * stride)
+				data.append(img.fp.read(stride))
+
+			sample = Image.frombytes(img.mode, (width, len(data)), b"".join(data), "raw", rawmode, stride, 1)
+
+			if img.palette:
+				sample.putpalette(img.palette)
+
+			return sample
+		else:
+			img.load()
+			return img.resize(size, Image.NEAREST)
+
+
+	@staticmethod
+	def __sampleStep(img, approx):
+		"Returns the step used to sample an image for approximate analysis, 1 if it shouldn't be sampled."
+		if not approx:
+			return 1
+
+		return max(1, int((img.size[0] * img.size[1] / ShaderGenerator.approxSamplePixels) ** 0.5))
+
+
+	@staticmethod
+	def __averageColor(histogram, pixels):
+		"Returns the average RGB color, with channels in [0,1], given an RGB histogram and the number of pixels."
+		value = channel = 0
+		average = [0, 0, 0]
+		for count in histogram:
+			average[channel] += count * ( value / 0xff )
+			value += 1
+			if value > 0xff:
+				average[channel] /= pixels
+				value = 0
+				channel += 1
+				if channel == 3:
+					break
+
+		return average
+
+
+	@staticmethod
+	def analyzeDiffuseMap(source, rows = None, approx = None, log = None):
+		"Retrieves metadata from a diffuse map, such as whether there's an alpha channel. source can be a path or the "
+		"file content. If rows is given, the map is analysed in strips of that height and the peak memory usage is "
+		"stored as peakMemory. If approx is given, a sample of the map is checked first and the full map is only "
+		"analysed if the sample is inconclusive. The results are exact in any case."
+		meta     = dict()
+		baseline = ShaderGenerator.__resetPeakMemory() if rows else None
+
+		with Image.open(io.BytesIO(source) if type(source) == bytes else source, "r") as img:
+			# look for transparency
+			if img.mode in ("RGBA", "LA"):
+				alpha = [0] * 256 # alpha value -> pixel count
+				step  = ShaderGenerator.__sampleStep(img, approx)
+
+				# a sample can only prove non-binary transparency
+				if step > 1:
+					alpha = ShaderGenerator.sampleImage(img, step).histogram()[-256:]
+
+				if not any(alpha[1:255]):
+					alpha = [0] * 256
+
+					for strip in ShaderGenerator.imageStrips(img, rows):
+						for value, count in enumerate(strip.histogram()[-256:]):
+							alpha[value] += count
+
+				if not any(alpha[:255]):
+					if log:
+						log("Found completely white alpha channel in "+str(source)+".")
+					meta["diffuseAlpha"] = False
 				else:
-					shader["meta"]["additionAverage"] = tuple(average)
+					meta["diffuseAlpha"] = True
+			elif img.mode == "p" and "transparency" in img.info:
+				meta["diffuseAlpha"] = True
+			else:
+				meta["diffuseAlpha"] = False
+
+			# check if transparency is binary
+			meta["diffuseAlphaBin"] = False
+			if meta["diffuseAlpha"]:
+				if not any(alpha[1:255]):
+					meta["diffuseAlphaBin"] = True
+
+		if rows:
+			meta["peakMemory"] = ShaderGenerator.__peakMemory(baseline)
+
+		return meta
+
+
+	@staticmethod
+	def analyzeAdditionMap(source, precalcColors, rows = None, approx = None, log = None):
+		"Retrieves metadata from an addition map, such as whether it's grayscale. source can be a path or the file "
+		"content. If rows is given, the map is analysed in strips of that height and the peak memory usage is stored "
+		"as peakMemory. If approx is given, the average color is calculated from a sample of the map if its error is "
+		"below approx with high confidence. This is only done for uncompressed maps, whose sample consists of random "
+		"rows. The grayscale check stays exact."
+		meta      = dict()
+		baseline  = ShaderGenerator.__resetPeakMemory() if rows else None
+		colors    = set()     # distinct colors, None if there are more than 256
+		histogram = [0] * 768 # RGB histogram
+		average   = None
+
+		img = Image.open(io.BytesIO(source) if type(source) == bytes else source, "r")
+
+		try:
+			gray   = ( img.mode in ("L", "LA") )
+			size   = img.size
+			step   = ShaderGenerator.__sampleStep(img, approx)
+			rawMap = ShaderGenerator.__rawLayout(img) != None
+
+			checkColors = not gray
+			countColors = precalcColors
+
+			if step > 1:
+				sample = ShaderGenerator.sampleImage(img, step).convert("RGB")
+
+				# a sample can only prove that there is color
+				if checkColors:
+					sampleColors = sample.getcolors(maxcolors = 256)
+
+					if not sampleColors or any(not rgb[0] == rgb[1] == rgb[2] for _, rgb in sampleColors):
+						colors      = None
+						checkColors = False
+
+				# use the sample's average color if its standard error is small enough
+				if countColors:
+					sampleAverage = ShaderGenerator.__averageColor(sample.histogram(), sample.size[0] * sample.size[1])
+
+					if rawMap and sample.size[1] > 1:
+						# the rows are a random sample of the image's rows, so the error follows from the spread
+						# of their averages, whatever the pattern of the image
+						rowCount = sample.size[1]
+						rowMeans = list(sample.resize((1, rowCount), Image.BOX).getdata())
+						error    = 0
+
+						for channel in range(3):
+							mean     = sum(rgb[channel] for rgb in rowMeans) / rowCount / 0xff
+							variance = sum(( rgb[channel] / 0xff - mean )**2 for rgb in rowMeans) / ( rowCount - 1 )
+							error    = max(error, 3 * ( variance / rowCount * ( 1 - rowCount / size[1] ) )**0.5)
+					else:
+						# not a random sample, its average can be arbitrarily wrong, even for JPEG images decoded at a
+						# reduced scale due to clamping during color conversion
+						error = None
+
+					if error != None and error <= approx:
+						average     = sampleAverage
+						countColors = False
+
+				del sample
+
+				# JPEG images need to be opened again for the full scale
+				if img.size != size and ( checkColors or countColors ):
+					img.close()
+					img = Image.open(io.BytesIO(source) if type(source) == bytes else source, "r")
+
+			if checkColors or countColors:
+				for strip in ShaderGenerator.imageStrips(img, rows):
+					strip = strip.convert("RGB")
+
+					# collect colors to check for RGB images with no actual non-gray color
+					if checkColors and colors != None:
+						stripColors = strip.getcolors(maxcolors = 256)
+
+						if stripColors:
+							colors.update(rgb for _, rgb in stripColors)
+
+						if not stripColors or len(colors) > 256:
+							colors = None
+
+					if countColors:
+						for value, count in enumerate(strip.histogram()):
+							histogram[value] += count
+
+					del strip
+		finally:
+			img.close()
+
+		if not gray and colors:
+			gray = True
+			for rgb in colors:
+				if not rgb[0] == rgb[1] == rgb[2]:
+					gray = False
+					break
+
+		meta["additionGrayscale"] = gray
+
+		# get average color if needed
+		if precalcColors:
+			if not average:
+				average = ShaderGenerator.__averageColor(histogram, size[0] * size[1])
+
+			if gray:
+				meta["additionAverage"] = (average[0], average[0], average[0])
+			else:
+				meta["additionAverage"] = tuple(average)
+
+		if rows:
+			meta["peakMemory"] = ShaderGenerator.__peakMemory(baseline)
+
+		return meta
+
+
+	@staticmethod
+	def estimateMemory(size, mode, fileSize, rows = None, raw = False, convert = False):
+		"Estimates the memory in bytes needed to analyse a map from its dimensions, mode and file size. The file "
+		"content is held twice by both the reading process, which pickles it, and the analysing process, which "
+		"unpickles it. The decoded pixels take one byte per pixel for single band modes and four bytes otherwise. "
+		"Only uncompressed maps, given by raw, are decoded a strip of rows at a time for tiled analysis, others are "
+		"decoded as a whole and then cropped into strips. If convert is given, each strip is also copied as RGB."
+		width, height = size
+		pixelSize     = 1 if mode in ("1", "L", "P") else 4
+		stripHeight   = min(rows or height, height)
+
+		if raw:
+			decoded = width * stripHeight * pixelSize
+		elif stripHeight < height:
+			decoded = width * ( height + stripHeight ) * pixelSize
+		else:
+			decoded = width * height * pixelSize
+
+		return 4 * fileSize + decoded + ( width * stripHeight * 4 if convert else 0 )
+
+
+	@staticmethod
+	def estimateMapMemory(path, rows = None, convert = False):
+		"Estimates the memory in bytes needed to analyse a map file, see estimateMemory. Maps whose header can't be "
+		"read are estimated from their file size only."
+		fileSize = os.path.getsize(path)
+
+		try:
+			with Image.open(path, "r") as img:
+				raw = ShaderGenerator.__rawLayout(img) != None
+
+				return ShaderGenerator.estimateMemory(img.size, img.mode, fileSize, rows, raw, convert)
+		except Exception:
+			return 4 * fileSize
+
+
+	@staticmethod
+	def __processMemory():
+		"Returns the resident memory in bytes of this process and its child processes, if available."
+		try:
+			pids = [str(os.getpid())]
+
+			for task in os.listdir("/proc/self/task"):
+				with open("/proc/self/task/"+task+"/children", "r") as fp:
+					pids += fp.read().split()
+		except OSError:
+			return None
+
+		total = 0
+
+		for pid in pids:
+			try:
+				with open("/proc/"+pid+"/status", "r") as fp:
+					for line in fp:
+						if line.startswith("VmRSS:"):
+							total += int(line.split()[1]) * 1024
+			except OSError:
+				pass # process has exited
+
+		return total
+
+
+	def __mapJobs(self, shader):
+		"Returns the paths of a shader's maps that need to be analysed, together with the kind of metadata needed."
+		jobs = [(shader["abspath"]+os.path.sep+shader["diffuse"]+shader["ext"]["diffuse"], "diffuse")]
+
+		if shader["addition"]:
+			path = shader["abspath"]+os.path.sep+shader["addition"]+shader["ext"]["addition"]
+
+			if shader["options"]["precalcColors"] and self.analysisError:
+				jobs.append((path, "additionApproxAverage"))
+			elif shader["options"]["precalcColors"]:
+				jobs.append((path, "additionAverage"))
+			else:
+				jobs.append((path, "addition"))
+
+		return jobs
+
+
+	def __analyzeMaps(self, shader):
+		"Retrieves metadata from a shader's maps, such as whether there's an alpha channel on the diffuse map. "
+		"Maps with identical content are only analysed once."
+		for path, kind in self.__mapJobs(shader):
+			shader["meta"].update(self.__analyzeMap(path, kind))
 
 
 	def __addKeywords(self, shader):
@@ -474,11 +1049,9 @@ class ShaderGenerator(dict):
 
 		# attempt to guess additional keywords
 		if options["guessKeywords"]:
-			for surfaceParm, words in self.surfaceParms.items():
-				for word in words:
-					if word in shader["name"]:
-						keywords.setdefault("surfaceparm", set())
-						keywords["surfaceparm"].add(surfaceParm)
+			for key, value in self.keywordMatcher.match(shader["name"]):
+				keywords.setdefault(key, set())
+				keywords[key].add(value)
 
 		# overlay keywords defined in options, overwrite on conflict
 		if "keywords" in options:
@@ -506,14 +1079,15 @@ class ShaderGenerator(dict):
 							keywords.pop(key)
 
 
-	def __expandLightShaders(self, setname):
-		"Replaces every shader with an addition map with a set of shaders for each light color/intensity combination "
-		"(only intensity for non-grayscale addition maps) as well as a not glowing version."
+	def __expandLightShaders(self, shaders):
+		"Replaces every shader with an addition map in a shader name to shader mapping with a set of shaders for each "
+		"light color/intensity combination (only intensity for non-grayscale addition maps) as well as a not glowing "
+		"version."
 		newShaders = dict()
 		delNames   = set()
 
-		for shadername in self.sets[setname]:
-			shader = self.sets[setname][shadername]
+		for shadername in shaders:
+			shader = shaders[shadername]
 
 			if shader["addition"]:
 				# mark original shader for deletion
@@ -543,14 +1117,15 @@ class ShaderGenerator(dict):
 
 		# delete old reference to the original
 		for shadername in delNames:
-			self.sets[setname].pop(shadername)
+			shaders.pop(shadername)
 
 		# add new shaders (adds back original shader under new name, without addition map)
-		self.sets[setname].update(newShaders)
+		shaders.update(newShaders)
 
 
-	def generateSet(self, path, setname = None, cutextension = None):
-		"Generates shader data for a given texture source folder."
+	def __collectSet(self, path, setname = None, cutextension = None):
+		"Lists a texture source folder and parses its option files. Returns the set name and the new shaders, whose maps "
+		"have not yet been analysed."
 		abspath    = os.path.abspath(path)
 		root       = os.path.basename(os.path.abspath(path+os.path.sep+os.path.pardir))
 		relpath    = root+"/"+os.path.basename(abspath)
@@ -558,6 +1133,7 @@ class ShaderGenerator(dict):
 		mapsbytype = dict() # map type -> set of filenames without extentions
 		mapext     = dict() # map name (no extension) -> map filename (with extension)
 		slothfiles = set()  # sloth per-shader config file names (no extension)
+		suffixes   = self.suffixes # setSuffixes replaces rather than modifies it
 
 		# retrieve all maps by type
 		for filename in filelist:
@@ -566,7 +1142,7 @@ class ShaderGenerator(dict):
 			if ext == self.slothFileExt:
 				slothfiles.add(mapname)
 			else:
-				for (maptype, suffix) in self.suffixes.items():
+				for (maptype, suffix) in suffixes.items():
 					mapsbytype.setdefault(maptype, set())
 
 					if mapname.endswith(suffix):
@@ -580,8 +1156,6 @@ class ShaderGenerator(dict):
 			else:
 				setname = relpath
 
-		self.sets.setdefault(setname, dict())
-
 		# parse per-directory options
 		options = dict()
 
@@ -592,11 +1166,17 @@ class ShaderGenerator(dict):
 			self.__parseSlothFile(options, abspath+os.path.sep+self.defaultSlothFile)
 
 		# add a shader for each diffuse map
+		shaders = list()
+
 		for diffusename in mapsbytype["diffuse"]:
-			shadername = diffusename.rsplit(self.suffixes["diffuse"], 1)[0]
+			shadername = diffusename.rsplit(suffixes["diffuse"], 1)[0]
+
+			if not self.__inShard(setname, shadername):
+				continue
 
 			# add a new shader
-			shader = self.sets[setname][shadername] = dict()
+			shader = dict()
+			shaders.append(shader)
 
 			# copy default options
 			self.__copyOptions(options, shader)
@@ -622,7 +1202,7 @@ class ShaderGenerator(dict):
 
 			# attempt to find a map of every known non-diffuse type
 			# assumes that non-diffuse map names form the start of diffuse map names
-			for maptype, suffix in self.suffixes.items():
+			for maptype, suffix in suffixes.items():
 				basename = shadername
 
 				while basename != "":
@@ -639,268 +1219,1699 @@ class ShaderGenerator(dict):
 					shader[maptype]        = None
 					shader["ext"][maptype] = None
 
-			# retrieve more metadata from the maps
-			self.__analyzeMaps(shader)
+		return setname, shaders
+
+
+	def __finishSet(self, setname, shaders):
+		"Adds shaders whose maps have been analysed to a set."
+		newShaders = dict() # shader name -> shader
+
+		for shader in shaders:
+			newShaders[shader["name"]] = shader
 
 			# now that we have enough knowledge about the shader, add keywords
 			self.__addKeywords(shader)
 
-		numVariants = str(len(self.sets[setname]))
+		numVariants = str(len(newShaders))
 
 		# expand relevant shaders into multiple light emitting ones
-		self.__expandLightShaders(setname)
+		self.__expandLightShaders(newShaders)
 
-		numShaders = str(len(self.sets[setname]))
+		numShaders = str(len(newShaders))
+
+		self.__addShaders(setname, newShaders)
 
 		self.verbose(setname+": Added "+numShaders+" shaders for "+numVariants+" texture variants.")
 
 
+	def __addShaders(self, setname, shaders):
+		"Adds shaders to a set. The set is replaced by an extended copy instead of being modified, so that other "
+		"threads can keep reading it."
+		with self.setsLock:
+			extended = dict(self.sets.get(setname, ()))
+			extended.update(shaders)
+			self.sets[setname] = extended
+
+
+	def generateSet(self, path, setname = None, cutextension = None):
+		"Generates shader data for a given texture source folder."
+		setname, shaders = self.__collectSet(path, setname, cutextension)
+
+		# retrieve more metadata from the maps
+		for shader in shaders:
+			self.__analyzeMaps(shader)
+
+		self.__finishSet(setname, shaders)
+
+
+	def generateSets(self, pathes, setname = None, cutextension = None, jobs = None, ioThreads = 8, queueSize = 32,
+	                 maxMemory = None):
+		"Generates shader data for multiple texture source folders, like calling generateSet for each of them. Listing "
+		"folders and reading maps is overlapped with analysing maps in up to jobs worker processes. If maxMemory is "
+		"given in bytes, maps are analysed only while their estimated memory usage fits into it, largest first within "
+		"windows of queueSize maps, so that folders are still being listed while the first maps are analysed."
+		asyncio.run(self.__generateSetsAsync(pathes, setname, cutextension, jobs, ioThreads, queueSize, maxMemory))
+
+
+	async def __generateSetsAsync(self, pathes, setname, cutextension, jobs, ioThreads, queueSize, maxMemory):
+		"Runs a pipeline of folder listing, map reading and map analysis stages, connected by bounded queues. Maps "
+		"are admitted to the pipeline by a memory budget, if any."
+		loop   = asyncio.get_running_loop()
+		budget = asyncio.Condition()
+		usage  = {"estimate": 0, "peakEstimate": 0, "peak": None} # bytes
+
+		async def admit(cost):
+			# a single map that exceeds the budget is analysed on its own
+			async with budget:
+				await budget.wait_for(lambda: usage["estimate"] == 0 or usage["estimate"] + cost <= maxMemory)
+				usage["estimate"]     += cost
+				usage["peakEstimate"]  = max(usage["peakEstimate"], usage["estimate"])
+
+		async def release(cost):
+			async with budget:
+				usage["estimate"] -= cost
+				budget.notify_all()
+
+		with concurrent.futures.ThreadPoolExecutor(ioThreads) as ioPool, \
+		     concurrent.futures.ProcessPoolExecutor(jobs) as cpuPool:
+			readQueue    = asyncio.Queue(queueSize) # (entry, kind, path) of maps to be read
+			analyzeQueue = asyncio.Queue(queueSize) # (entry, kind, path, content) of maps to be analysed
+			failures     = list()                   # exceptions raised by the read and analysis stages
+
+			async def produce():
+				scheduled = set()  # (entry id, kind)
+				pending   = list() # (estimate future, entry, kind, path) of the window to be admitted by memory budget
+				estimated = list() # estimated bytes of all admitted maps
+
+				async def admitWindow():
+					# admit the window largest first while its estimates fit into the budget
+					costs = await asyncio.gather(*(future for future, _, _, _ in pending))
+					jobs  = sorted(zip(costs, [job[1:] for job in pending]), key = lambda job: -job[0])
+					pending.clear()
+
+					for cost, (entry, kind, path) in jobs:
+						if cost > maxMemory:
+							self.error("Estimated "+"%.1f" % (cost / 2**20)+" MiB to analyse "+path+", exceeding "
+							           "the memory budget.")
+
+						await admit(cost)
+						await readQueue.put((entry, kind, path, cost))
+						estimated.append(cost)
+
+				# list all folders at once but add their shaders in order
+				listings = [loop.run_in_executor(ioPool, self.__collectSet, path, setname, cutextension)
+				            for path in pathes]
+				sets     = list()
+
+				for listing in listings:
+					name, shaders = await listing
+					sets.append((name, shaders))
+
+					# look up the content keys of all maps of the folder at once, limited by the I/O threads
+					jobs    = [(shader, path, kind) for shader in shaders for path, kind in self.__mapJobs(shader)]
+					entries = await asyncio.gather(*(loop.run_in_executor(ioPool, self.__findMapEntry, path)
+					                                 for _, path, _ in jobs))
+
+					for shader in shaders:
+						shader["jobs"] = list()
+
+					for (shader, path, kind), entry in zip(jobs, entries):
+						shader["jobs"].append((entry, kind))
+
+						if kind not in entry["meta"] and (id(entry), kind) not in scheduled:
+							scheduled.add((id(entry), kind))
+
+							if maxMemory:
+								cost = loop.run_in_executor(ioPool, self.estimateMapMemory, path, self.analysisRows,
+								                            kind != "diffuse")
+								pending.append((cost, entry, kind, path))
+
+								if len(pending) >= queueSize:
+									await admitWindow()
+							else:
+								await readQueue.put((entry, kind, path, 0))
+						else:
+							self.debug("Reusing "+kind+" metadata of "+entry["path"]+" for "+path+".")
+
+				if pending:
+					await admitWindow()
+
+				if estimated:
+					self.verbose("Estimated "+"%.1f" % (sum(estimated) / 2**20)+" MiB to analyse "+str(len(estimated))+
+					             " maps with a budget of "+"%.1f" % (maxMemory / 2**20)+" MiB.")
+
+				return sets
+
+			async def sample():
+				while True:
+					memory = self.__processMemory()
+
+					if memory != None:
+						usage["peak"] = max(usage["peak"] or 0, memory)
+
+					await asyncio.sleep(0.05)
+
+			async def read():
+				while True:
+					entry, kind, path, cost = await readQueue.get()
+					try:
+						content = await loop.run_in_executor(ioPool, self.__readFile, path)
+						await analyzeQueue.put((entry, kind, path, content, cost))
+					except Exception as error:
+						failures.append(error)
+						await release(cost)
+					finally:
+						readQueue.task_done()
+
+			async def analyze():
+				while True:
+					entry, kind, path, content, cost = await analyzeQueue.get()
+					try:
+						function, args = self.__mapAnalyzer(kind)
+						meta = await loop.run_in_executor(cpuPool, function, content, *args)
+						self.__storeAnalysis(entry, kind, path, meta)
+					except Exception as error:
+						failures.append(error)
+					finally:
+						del content
+						await release(cost)
+						analyzeQueue.task_done()
+
+			readers   = [asyncio.create_task(read()) for _ in range(ioThreads)]
+			analyzers = [asyncio.create_task(analyze()) for _ in range(jobs or os.cpu_count() or 1)]
+			sampler   = asyncio.create_task(sample()) if maxMemory else None
+
+			try:
+				sets = await produce()
+				await readQueue.join()
+				await analyzeQueue.join()
+			finally:
+				for task in readers + analyzers + [sampler]:
+					if task:
+						task.cancel()
+
+			if failures:
+				raise failures[0]
+
+		if maxMemory:
+			self.verbose("Peak estimated analysis memory was "+"%.1f" % (usage["peakEstimate"] / 2**20)+" MiB.")
+
+			if usage["peak"] != None:
+				self.verbose("Peak resident memory of this process and its workers was "+"%.1f" % (usage["peak"] / 2**20)+
+				             " MiB.")
+
+		for name, shaders in sets:
+			for shader in shaders:
+				for entry, kind in shader.pop("jobs"):
+					shader["meta"].update(copy.deepcopy(entry["meta"][kind]))
+
+			self.__finishSet(name, shaders)
+
+
+	def __readFile(self, path):
+		"Returns the content of a file."
+		with open(path, "rb") as fp:
+			return fp.read()
+
+
 	def clearSets(self):
 		"Forgets about all shader data that has been generated."
-		self.sets.clear()
+		with self.setsLock:
+			self.sets.clear()
+
+		self.renderCache.clear()
 
 		self.verbose("Cleared all sets.")
 
 
-	def __radToAdd(self, shader, r, g = None, b = None):
-		"Given light colors, return modified colors to be used in the blend phase of the addition map."
-		exp = shader["options"]["radToAddExp"]
+	# magic number and version of the snapshot format written by saveSnapshot
+	snapshotMagic   = b"SLOTHSNAP"
+	snapshotVersion = 1
 
-		if g and b:
-			return (r**exp, g**exp, b**exp)
-		else:
-			return r**exp
+	# options that only affect how shaders are written, they can be changed after loading a snapshot
+	outputOptions = ("renderer", "editorOpacity", "alphaTest", "heightNormalsMod", "radToAddExp")
 
 
-	def getShader(self, setname = None, shadername = None):
-		"Assembles and returns the shader file content."
-		content = ""
+	class __SnapshotUnpickler(pickle.Unpickler):
+		"Unpickles snapshots, which consist of builtin containers only, without importing anything."
 
-		for line in self.header.splitlines():
-			if line.startswith("//"):
-				content += line+"\n"
-			else:
-				content += "// "+line+"\n"
+		def find_class(self, module, name):
+			raise pickle.UnpicklingError("Snapshots may not contain "+module+"."+name+".")
 
-		if setname:
-			if setname in self.sets:
-				setnames = (setname, )
-			else:
-				self.error("Unknown set "+str(setname)+".")
-				return
-		else:
-			setnames = self.sets.keys()
 
-		for setname in setnames:
-			if shadername:
-				if shadername in self.sets[setname]:
-					names = (shadername, )
-				else:
-					continue
-			else:
-				content += "\n"+\
-				           "// "+"-"*len(setname)+"\n"+\
-				           "// "+setname+"\n"+\
-				           "// "+"-"*len(setname)+"\n"
+	def saveSnapshot(self, fp):
+		"Writes all generated shader data to a binary file, so that a later run can write the shaders without "
+		"generating them again."
+		with self.optionsLock:
+			data = pickle.dumps({"options": self["options"], "sets": self.sets}, protocol = 5)
 
-				names = sorted(self.sets[setname].keys())
+		fp.write(self.snapshotMagic + struct.pack("<H", self.snapshotVersion) + zlib.compress(data))
 
-			for shadername in names:
-				# prepare content
-				shader = self.sets[setname][shadername]
-				path   = shader["relpath"]+"/"
+		self.verbose("Saved snapshot of "+str(sum(len(shaders) for shaders in self.sets.values()))+" shaders.")
 
-				# decide on a preview image
-				if shader["preview"]:
-					preview = shader["preview"]
-				elif shader["diffuse"]:
-					preview = shader["diffuse"]
-				else:
-					preview = None
-
-				# extract light color if available
-				if "lightColor" in shader["meta"]:
-					r = shader["meta"]["lightColor"]["r"] / 0xff
-					g = shader["meta"]["lightColor"]["g"] / 0xff
-					b = shader["meta"]["lightColor"]["b"] / 0xff
-
-				content += "\n"+setname+"/"+shadername+"\n{\n"
-
-				# preview image
-				if preview:
-					content += "\tqer_editorImage     "+path+preview+"\n"
-
-					# in-editor transparency
-					if shader["meta"]["diffuseAlpha"] and shader["options"]["editorOpacity"] < 1:
-						content += "\tqer_trans           "+"%.2f"%shader["options"]["editorOpacity"]+"\n"
-
-					content += "\n"
-
-				# keywords
-				if "keywords" in shader and len(shader["keywords"]) > 0:
-					for key, value in sorted(shader["keywords"].items()):
-						if type(value) != str and hasattr(value, "__iter__"):
-							for value in sorted(value):
-								content += "\t"+key+" "*max(1, 20-len(key))+str(value)+"\n"
-						elif value == None:
-							content += "\t"+key+"\n"
-						else:
-							content += "\t"+key+" "*max(1, 20-len(key))+str(value)+"\n"
-
-					content += "\n"
-
-				# surface light
-				if "lightIntensity" in shader["meta"] and shader["meta"]["lightIntensity"] > 0:
-					# intensity
-					content += "\tq3map_surfacelight  "+"%d" % shader["meta"]["lightIntensity"]+"\n"
-
-					# color
-					if "lightColor" in shader["meta"]:
-						content += "\tq3map_lightRGB      "+"%.3f %.3f %.3f" % (r, g, b)+"\n\n"
-					elif "additionAverage" in shader["meta"]:
-						content += "\tq3map_lightRGB      "+"%.3f %.3f %.3f" % shader["meta"]["additionAverage"]+"\n\n"
-					elif shader["addition"]:
-						content += "\tq3map_lightImage    "+shader["addition"]+"\n\n"
-					elif shader["diffuse"]:
-						content += "\tq3map_lightImage    "+shader["diffuse"]+"\n\n"
-					else:
-						content += "\tq3map_lightRGB      1.000 1.000 1.000\n\n"
 
-				# diffuse map
-				if shader["diffuse"]:
+	def loadSnapshot(self, fp):
+		"Adds the shader data of a snapshot written by saveSnapshot. Output options that have been set differently "
+		"since the snapshot was taken apply to all shaders that don't override them. Returns whether the snapshot "
+		"could be read."
+		header = fp.read(len(self.snapshotMagic) + 2)
 
-					# with alpha channel
-					if shader["meta"]["diffuseAlpha"]:
-						content += "\t{\n"+\
-						           "\t\tmap       "+path+shader["diffuse"]+"\n"
+		if not header.startswith(self.snapshotMagic):
+			self.error("Not a snapshot file.")
+			return False
 
-						if shader["options"]["renderer"] != "quake3":
-							content += "\t\tstage     diffuseMap\n"
+		version = struct.unpack("<H", header[len(self.snapshotMagic):])[0]
 
-						# alphatest forced
-						if shader["options"]["alphaTest"]:
-							if type(shader["options"]["alphaTest"]) == str:
-								content += "\t\talphaFunc "+shader["options"]["alphaTest"]+"\n"
-							else:
-								content += "\t\talphaTest "+"%.2f"%shader["options"]["alphaTest"]+"\n"
+		if version != self.snapshotVersion:
+			self.error("Can't read snapshot of version "+str(version)+".")
+			return False
 
-						# alphatest implied by binary alpha values
-						elif shader["meta"]["diffuseAlphaBin"]:
-							content += "\t\talphaFunc GE128\n"
+		# the collector would repeatedly scan the many new containers
+		enabled = gc.isenabled()
+		gc.disable()
 
-						# smooth blending
-						else:
-							content += "\t\tblend     blend\n"
+		try:
+			data = self.__SnapshotUnpickler(io.BytesIO(zlib.decompress(fp.read()))).load()
+		finally:
+			if enabled:
+				gc.enable()
 
-						content += "\t}\n"
+		changed = [key for key in self.outputOptions if data["options"][key] != self["options"][key]]
 
-					# without alpha channel
-					elif shader["options"]["renderer"] != "quake3":
-						content += "\tdiffuseMap          "+path+shader["diffuse"]+"\n"
-					else:
-						content += "\t{\n"+\
-						           "\t\tmap   "+path+shader["diffuse"]+"\n"+\
-						           "\t}\n"
-
-				# normal & height map
-				if shader["options"]["renderer"] != "quake3":
-					if shader["normal"]:
-						if shader["height"] and shader["options"]["heightNormalsMod"] > 0:
-							content += "\tnormalMap           addnormals ( "+path+shader["normal"]+\
-									   ", heightmap ( "+path+shader["height"]+", "+\
-									   "%.2f" % shader["options"]["heightNormalsMod"]+" ) )\n"
-						else:
-							content += "\tnormalMap           "+path+shader["normal"]+"\n"
-					elif shader["height"] and shader["options"]["heightNormalsMod"] > 0:
-						content += "\tnormalMap           heightmap ( "+path+shader["height"]+", "+\
-								   "%.2f" % shader["options"]["heightNormalsMod"]+" )\n"
-
-				# specular map
-				if shader["options"]["renderer"] != "quake3":
-					if shader["specular"]:
-						content += "\tspecularMap         "+path+shader["specular"]+"\n"
-
-				# addition map
-				if shader["addition"]:
-					if shader["options"]["renderer"] == "daemon" \
-					and ("lightColor" not in shader["meta"] or r == b == g == 1.0):
-						content += "\tglowMap             "+path+shader["addition"]+"\n"
-					else:
-						content += "\t{\n"+\
-						           "\t\tmap   "+path+shader["addition"]+"\n"+\
-						           "\t\tblend add\n"
-						if "lightColor" in shader["meta"] and r + g + b < 3.0:
-							content += \
-							       "\t\tred   "+"%.3f" % self.__radToAdd(shader, r)+"\n"+\
-							       "\t\tgreen "+"%.3f" % self.__radToAdd(shader, g)+"\n"+\
-							       "\t\tblue  "+"%.3f" % self.__radToAdd(shader, b)+"\n"
-						content += "\t}\n"
-
-				content += "}\n"
+		for setname, shaders in data["sets"].items():
+			if changed:
+				for shader in shaders.values():
+					for key in changed:
+						if shader["options"][key] == data["options"][key]:
+							shader["options"][key] = self["options"][key]
 
-		return content
+			self.__addShaders(setname, shaders)
 
+		self.verbose("Loaded snapshot of "+str(sum(len(shaders) for shaders in data["sets"].values()))+" shaders.")
 
-class ExampleConfig(argparse.Action):
-	example = \
-"""
-# This is a per-directory/shader configuration file for Sloth.
-#
-# Sloth is a Python tool that generates XreaL/Daemon shader files from
-# directories of texture maps. Sloth is free software and can be found at
-# https://github.com/Unvanquished/Sloth
-#
-# The command line arguments used to invoke Sloth are global defaults for all
-# shaders. They can be changed on a per-directory level by putting a file
-# named "options.sloth" in the texture source folder. Other files ending in
-# ".sloth" are read when their basename forms the beginning of the shader name
-# in question. It is possible to have multiple sloth files overlay each other
-# in a hierarchical order, for example one named "metal.sloth" that adds the
-# "metalsteps" surface parameter to every shader starting with "metal" and one
-# named "metaleatingbacteria.sloth" that removes it and adds the "flesh"
-# surfaceparm instead for shaders starting with the respective string.
-#
-# An example configuration can be generated with the -e/--example-config
-# argument. Be aware that sloth files are case-sensitive.
+		return True
 
-# The "options" section contains mostly keywords that correspond to command
-# line options. For a detailed description of their function invoke Sloth with
-# the -h/--help option.
-[options]
-# Corresponds to --colors
-#colors = red:ff0000 green:00ff00
 
-# Like "colors" but doesn't clear previous values
-#addColors = blue:0000ff white:ffffff
+	# version of the shard file format written by saveShard
+	shardVersion = 1
 
-# Corresponds to --custom-lights
-#customLights = 1000 2000
 
-# Like "customLights" but doesn't clear previous values
-#addCustomLights = 3000 4000
+	def __inShard(self, setname, shadername):
+		"Whether a shader belongs to the shard that is being generated. Doesn't depend on the machine or the order of "
+		"the maps."
+		if not self.shard:
+			return True
 
-# Corresponds to --predef-lights
-#predefLights = 100 200
+		return zlib.crc32((setname+"/"+shadername).encode()) % self.shard[1] == self.shard[0]
 
-# Corresponds to --precalc-colors
-#precalcColors = on
 
-# Like "predefLights" but doesn't clear previous values
-#addPredefLights = 300 400
+	@staticmethod
+	def __encodeModel(value):
+		"Converts sets and tuples in shader data to tagged lists, so that they can be stored as JSON."
+		if type(value) == dict:
+			return {key: ShaderGenerator.__encodeModel(item) for key, item in value.items()}
+		elif type(value) == list:
+			return [ShaderGenerator.__encodeModel(item) for item in value]
+		elif type(value) == set:
+			return {"__set__": [ShaderGenerator.__encodeModel(item) for item in sorted(value)]}
+		elif type(value) == tuple:
+			return {"__tuple__": [ShaderGenerator.__encodeModel(item) for item in value]}
+		else:
+			return value
 
-# Corresponds to --color-blend-exp
-#colorBlendExp = 1.2
 
-# Correspond to --gt0, --ge128 and --lt128, respectively
-#alphaFunc = GT0
-#alphaFunc = GE128
-#alphaFunc = LT128
+	@staticmethod
+	def __decodeModel(value):
+		"Restores sets and tuples converted by __encodeModel, used as a JSON object hook."
+		if len(value) == 1 and "__set__" in value:
+			return set(value["__set__"])
+		elif len(value) == 1 and "__tuple__" in value:
+			return tuple(value["__tuple__"])
+		else:
+			return value
 
-# Corresponds to --alpha-test
-#alphaTest = 0.5
 
-# Value "off" corresponds to --no-alpha-shadows
-#alphaShadows = off
+	def saveShard(self, fp):
+		"Writes the generated shaders of the current shard to a file, in a format that doesn't depend on the machine."
+		json.dump({"version": self.shardVersion, "shard": self.shard or (0, 1), "sets": self.__encodeModel(self.sets)}, fp)
+
+		self.verbose("Saved shard "+str((self.shard or (0, 1))[0])+" of "+str((self.shard or (0, 1))[1])+".")
+
+
+	def mergeShards(self, fps):
+		"Adds the shaders of all shard files written by saveShard. The result is the same as if all shaders had been "
+		"generated at once. Nothing is added unless all shards of the same shard count are given exactly once. Returns "
+		"whether the shards could be merged."
+		shards = dict() # shard index -> (shard count, sets)
+
+		for fp in fps:
+			data = json.load(fp, object_hook = self.__decodeModel)
+
+			if data["version"] != self.shardVersion:
+				self.error("Can't read shard file of version "+str(data["version"])+".")
+				return False
+
+			index, count = data["shard"]
+
+			if index in shards:
+				self.error("Shard "+str(index)+" given more than once.")
+				return False
+
+			shards[index] = (count, data["sets"])
+
+		counts = set(count for count, _ in shards.values())
+
+		if len(counts) > 1:
+			self.error("Shard files have been generated with different numbers of shards.")
+			return False
+		elif counts and sorted(shards) != list(range(counts.pop())):
+			self.error("Shards "+str(sorted(set(range(max(count for count, _ in shards.values()))) - set(shards)))+
+			           " are missing.")
+			return False
+
+		# all shards contain all sets in the same order
+		for index in sorted(shards):
+			for setname, shaders in shards[index][1].items():
+				self.__addShaders(setname, shaders)
+
+		self.verbose("Merged "+str(len(shards))+" shards with "+str(sum(len(shaders) for shaders in self.sets.values()))+
+		             " shaders.")
+
+		return True
+
+
+	# PNG text key that marks preview images generated by Sloth, its value is the source map's file name
+	previewKey = "Sloth-Preview-Source"
+
+
+	@staticmethod
+	def makePreview(source, target, size):
+		"Writes a PNG preview image with a maximum width and height of size pixels for a map."
+		with Image.open(source, "r") as img:
+			img.thumbnail((size, size))
+
+			if img.mode not in ("RGB", "RGBA", "L", "LA"):
+				img = img.convert("RGBA")
+
+			info = PngImagePlugin.PngInfo()
+			info.add_text(ShaderGenerator.previewKey, os.path.basename(source))
+
+			img.save(target, "PNG", pnginfo = info)
+
+		return target
+
+
+	def __previewUpToDate(self, shader):
+		"Whether a shader has a preview image that wasn't generated by Sloth, or one that is newer than its diffuse map."
+		preview = shader["abspath"]+os.path.sep+shader["preview"]+shader["ext"]["preview"]
+		diffuse = shader["abspath"]+os.path.sep+shader["diffuse"]+shader["ext"]["diffuse"]
+
+		try:
+			with Image.open(preview, "r") as img:
+				if img.info.get(self.previewKey) != os.path.basename(diffuse):
+					return self.previewKey not in img.info
+		except OSError:
+			return False
+
+		return os.stat(preview).st_mtime_ns >= os.stat(diffuse).st_mtime_ns
+
+
+	def generatePreviews(self, size = 128, jobs = None):
+		"Generates downscaled preview images for shaders that don't have one, using up to jobs worker processes, and "
+		"uses them for the shaders. The images are written next to the diffuse maps and are only generated again when "
+		"the diffuse map changes."
+		previews = dict() # preview path -> (diffuse path, shaders using it)
+
+		for setname, shaders in self.sets.items():
+			for shadername, shader in shaders.items():
+				if shader["preview"] and self.__previewUpToDate(shader):
+					continue
+
+				name    = shader["name"]+self.suffixes["preview"]
+				preview = shader["abspath"]+os.path.sep+name+".png"
+				diffuse = shader["abspath"]+os.path.sep+shader["diffuse"]+shader["ext"]["diffuse"]
+
+				previews.setdefault(preview, (diffuse, list()))[1].append((setname, shadername))
+
+		if not previews:
+			return
+
+		with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+			futures = dict()
+
+			for preview, (diffuse, _) in previews.items():
+				try:
+					# generated in an earlier run
+					if os.stat(preview).st_mtime_ns >= os.stat(diffuse).st_mtime_ns:
+						with Image.open(preview, "r") as img:
+							if img.info.get(self.previewKey) == os.path.basename(diffuse):
+								continue
+				except OSError:
+					pass
+
+				futures[preview] = pool.submit(self.makePreview, diffuse, preview, size)
+
+			for preview, future in futures.items():
+				future.result()
+				self.debug("Generated preview image "+preview+".")
+
+		for preview, (_, names) in previews.items():
+			for setname, shadername in names:
+				shader = self.sets[setname][shadername]
+				shader["preview"]        = os.path.splitext(os.path.basename(preview))[0]
+				shader["ext"]["preview"] = ".png"
+
+				self.invalidateShader(setname, shadername)
+
+		self.verbose("Generated "+str(len(futures))+" preview images, "+str(len(previews) - len(futures))+
+		             " were up to date.")
+
+
+	# PNG text key that marks normal maps baked by Sloth, its value describes the source maps
+	bakedKey = "Sloth-Baked-Source"
+
+	# subfolder of a texture source folder that baked normal maps are written to
+	bakedDir = "baked"
+
+
+	# maximum pixel values of high precision modes, whose pixels are clipped instead of scaled when converted to 8 bits
+	deepModeRanges = {"I": 0xffff, "I;16": 0xffff, "I;16L": 0xffff, "I;16B": 0xffff, "I;16N": 0xffff, "F": 1.0}
+
+
+	@staticmethod
+	def heightImage(img):
+		"Returns the luminance of an opened image as a floating point image with values in [0,1], keeping the "
+		"precision of 16 bit and floating point maps."
+		if img.mode in ShaderGenerator.deepModeRanges:
+			scale = 1 / ShaderGenerator.deepModeRanges[img.mode]
+		else:
+			img, scale = img.convert("L"), 1 / 0xff
+
+		return img.convert("F").point(lambda value: value * scale)
+
+
+	@staticmethod
+	def __wrapImage(img):
+		"Returns an image with a one pixel border taken from the opposite edges, so that tiling textures are filtered "
+		"seamlessly."
+		width, height = img.size
+		wrapped       = Image.new(img.mode, (width + 2, height + 2))
+
+		for x in (-width, 0, width):
+			for y in (-height, 0, height):
+				wrapped.paste(img, (x + 1, y + 1))
+
+		return wrapped
+
+
+	@staticmethod
+	def bakeNormalMap(height, normal, scale, target, signature):
+		"Computes a normal map from a height map using Sobel gradients, with heights in [0,1] multiplied by scale, and "
+		"writes it to target as a PNG image. If the path to a normal map is given, both are combined. signature is "
+		"stored in the image to detect changes of the sources. Uses NumPy if available."
+		with Image.open(height, "r") as img:
+			heightImg = ShaderGenerator.heightImage(img)
+
+		if normal:
+			with Image.open(normal, "r") as img:
+				normalImg = img.convert("RGB")
+
+			if heightImg.size != normalImg.size:
+				heightImg = heightImg.resize(normalImg.size, Image.BICUBIC)
+
+		if numpy:
+			p  = numpy.pad(numpy.asarray(heightImg, dtype = numpy.float32), 1, mode = "wrap")
+			gx = ( p[:-2, 2:] + 2 * p[1:-1, 2:] + p[2:, 2:] - p[:-2, :-2] - 2 * p[1:-1, :-2] - p[2:, :-2] ) / 8
+			gy = ( p[2:, :-2] + 2 * p[2:, 1:-1] + p[2:, 2:] - p[:-2, :-2] - 2 * p[:-2, 1:-1] - p[:-2, 2:] ) / 8
+
+			n  = numpy.dstack((-gx * scale, gy * scale, numpy.ones_like(gx)))
+			n /= numpy.linalg.norm(n, axis = 2, keepdims = True)
+
+			if normal:
+				m  = numpy.asarray(normalImg, dtype = numpy.float32) / 127.5 - 1
+				n  = numpy.dstack((n[..., 0] + m[..., 0], n[..., 1] + m[..., 1], n[..., 2] * m[..., 2]))
+				n /= numpy.maximum(numpy.linalg.norm(n, axis = 2, keepdims = True), 1e-6)
+
+			baked = Image.fromarray(numpy.clip(numpy.rint(( n * 0.5 + 0.5 ) * 255), 0, 255).astype(numpy.uint8), "RGB")
+		else:
+			# the same computation on whole bands, with the neighbours of each pixel taken from shifted crops
+			math          = getattr(ImageMath, "unsafe_eval", None) or ImageMath.eval
+			width, height = heightImg.size
+			wrapped       = ShaderGenerator.__wrapImage(heightImg)
+			shifted       = {name: wrapped.crop((dx + 1, dy + 1, width + dx + 1, height + dy + 1)) for name, (dx, dy) in
+			                 (("nw", (-1, -1)), ("n", (0, -1)), ("ne", (1, -1)), ("w", (-1, 0)),
+			                  ("e", (1, 0)), ("sw", (-1, 1)), ("s", (0, 1)), ("se", (1, 1)))}
+
+			x = math("-( ne + 2 * e + se - nw - 2 * w - sw ) / 8 * scale", scale = scale, **shifted)
+			y = math("( sw + 2 * s + se - nw - 2 * n - ne ) / 8 * scale", scale = scale, **shifted)
+			z = math("( x * x + y * y + 1 )**-0.5", x = x, y = y)
+			x = math("x * z", x = x, z = z)
+			y = math("y * z", y = y, z = z)
+
+			if normal:
+				mx, my, mz = (band.convert("F") for band in normalImg.split())
+				x = math("x + m / 127.5 - 1", x = x, m = mx)
+				y = math("y + m / 127.5 - 1", y = y, m = my)
+				z = math("z * ( m / 127.5 - 1 )", z = z, m = mz)
+				l = math("max(( x * x + y * y + z * z )**0.5, 0.000001)", x = x, y = y, z = z)
+				x, y, z = (math("c / l", c = c, l = l) for c in (x, y, z))
+
+			# conversion to 8 bits clips but truncates
+			baked = Image.merge("RGB", [math("( c * 0.5 + 0.5 ) * 255 + 0.5", c = c).convert("L") for c in (x, y, z)])
+
+		info = PngImagePlugin.PngInfo()
+		info.add_text(ShaderGenerator.bakedKey, signature)
+
+		baked.save(target, "PNG", pnginfo = info)
+
+		return target
+
+
+	def bakeNormals(self, jobs = None):
+		"Computes normal maps from the height maps of all shaders offline, combined with their normal maps if present, "
+		"using up to jobs worker processes. The results are written to a subfolder of the texture source folder and "
+		"replace the shaders' normal and height maps. Normal maps are only baked again when their sources change."
+		baked = dict() # baked map path -> (height path, normal path, scale, signature, shaders using it)
+
+		for setname, shaders in self.sets.items():
+			for shadername, shader in shaders.items():
+				scale = shader["options"]["heightNormalsMod"]
+
+				if not shader["height"] or scale <= 0:
+					continue
+
+				height = shader["abspath"]+os.path.sep+shader["height"]+shader["ext"]["height"]
+				normal = shader["abspath"]+os.path.sep+shader["normal"]+shader["ext"]["normal"] if shader["normal"] else None
+				name   = "_".join(([shader["normal"]] if normal else [])+[shader["height"], "%d" % round(scale * 100)])
+				target = shader["abspath"]+os.path.sep+self.bakedDir+os.path.sep+name+".png"
+
+				if target not in baked:
+					sources   = [(path, os.stat(path).st_mtime_ns) for path in (height, normal) if path]
+					signature = json.dumps([[os.path.basename(path), mtime] for path, mtime in sources]+[scale])
+					baked[target] = (height, normal, scale, signature, list())
+
+				baked[target][4].append((setname, shadername, self.bakedDir+"/"+name))
+
+		if not baked:
+			return
+
+		with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+			futures = dict()
+
+			for target, (height, normal, scale, signature, _) in baked.items():
+				try:
+					with Image.open(target, "r") as img:
+						if img.info.get(self.bakedKey) == signature:
+							continue
+				except OSError:
+					os.makedirs(os.path.dirname(target), exist_ok = True)
+
+				futures[target] = pool.submit(self.bakeNormalMap, height, normal, scale, target, signature)
+
+			for target, future in futures.items():
+				future.result()
+				self.debug("Baked normal map "+target+".")
+
+		for target, (_, _, _, _, names) in baked.items():
+			for setname, shadername, name in names:
+				shader = self.sets[setname][shadername]
+				shader["normal"]        = name
+				shader["ext"]["normal"] = ".png"
+				shader["height"]        = None
+				shader["ext"]["height"] = None
+
+				self.invalidateShader(setname, shadername)
+
+		self.verbose("Baked "+str(len(futures))+" normal maps, "+str(len(baked) - len(futures))+" were up to date.")
+
+
+	# output formats for transcoded maps: name -> (Pillow format, extension, lossless variant)
+	transcodeFormats = \
+	{
+		"png":  ("PNG",  ".png",  "png"),
+		"jpg":  ("JPEG", ".jpg",  "png"),
+		"webp": ("WEBP", ".webp", "webp"),
+	}
+
+	# map types that may be stored in a lossy format
+	lossyMapTypes = ("diffuse", "specular", "addition", "preview")
+
+	# file in the output folder that records the sources of transcoded maps
+	transcodeManifest = ".sloth-transcode.json"
+
+	# stored with the sources of transcoded maps, increased when transcoding changes so that maps are transcoded again
+	transcodeVersion = 2
+
+
+	@staticmethod
+	def transcodeMap(source, target, format, lossless, maxSize, powerOfTwo, alpha):
+		"Converts a map into the given format from transcodeFormats and writes it to target, which gets the format's "
+		"extension. Maps that need to be stored lossless or that have an alpha channel use the format's lossless "
+		"variant. If alpha is None, the alpha channel is kept if present. The map is scaled down to maxSize pixels "
+		"and/or power of two dimensions if requested. 16 bit maps stay 16 bit in PNG files. Returns the path to the "
+		"written file."
+		with Image.open(source, "r") as img:
+			img.load()
+
+			if alpha == None:
+				alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+
+			width, height = size = img.size
+
+			if maxSize:
+				width, height = min(width, maxSize), min(height, maxSize)
+
+			if powerOfTwo:
+				width, height = 2**(width.bit_length() - 1), 2**(height.bit_length() - 1)
+
+			if (width, height) != size:
+				img = img.resize((width, height), Image.LANCZOS)
+
+			if lossless or alpha:
+				lossless = True
+				format   = ShaderGenerator.transcodeFormats[format][2] or format
+
+			# scale 16 bit and floating point maps instead of clipping them, keeping 16 bits if the format allows it
+			if img.mode in ShaderGenerator.deepModeRanges:
+				values = ShaderGenerator.heightImage(img)
+
+				if format == "png" and not alpha:
+					img = values.point(lambda value: value * 0xffff + 0.5).convert("I").convert("I;16")
+				else:
+					img = values.point(lambda value: value * 0xff + 0.5).convert("L")
+
+			gray = img.mode in ("1", "L", "LA", "I;16") and format != "webp"
+
+			if alpha:
+				img = img.convert("LA" if gray else "RGBA")
+			elif img.mode != "I;16":
+				img = img.convert("L" if gray else "RGB")
+
+			pillowFormat, ext, _ = ShaderGenerator.transcodeFormats[format]
+			target += ext
+
+			os.makedirs(os.path.dirname(target), exist_ok = True)
+
+			if format == "jpg":
+				img.save(target, pillowFormat, quality = 90)
+			elif format == "webp":
+				img.save(target, pillowFormat, lossless = lossless, quality = 90)
+			else:
+				img.save(target, pillowFormat)
+
+		return target
+
+
+	def transcodeMaps(self, outdir, format = "jpg", maxSize = None, powerOfTwo = False, jobs = None):
+		"Converts all maps referenced by the shaders into an engine friendly format and writes them to outdir, keeping "
+		"their paths relative to the game directory, using up to jobs worker processes. format is used for maps without "
+		"alpha channel, if it's lossy it is only used for map types that can deal with it. The shaders are changed to "
+		"use the transcoded maps. Maps are only transcoded again if they or the parameters change."
+		manifestPath = outdir+os.path.sep+self.transcodeManifest
+		manifest     = dict() # source path -> [signature, target path]
+		maps         = dict() # source path -> (target path without extension, lossless, alpha, shaders)
+
+		if format not in self.transcodeFormats:
+			self.error("Format "+format+" not supported. Supported formats are "+str(tuple(self.transcodeFormats))+".")
+			return
+
+		try:
+			with open(manifestPath, "r") as fp:
+				manifest = json.load(fp)
+		except (OSError, ValueError):
+			pass
+
+		for setname, shaders in self.sets.items():
+			for shadername, shader in shaders.items():
+				for maptype in self.suffixes:
+					if not shader.get(maptype):
+						continue
+
+					source = shader["abspath"]+os.path.sep+shader[maptype]+shader["ext"][maptype]
+
+					if source not in maps:
+						target = os.path.join(outdir, *(shader["relpath"]+"/"+shader[maptype]).split("/"))
+
+						# keep maps that can't take compression artifacts lossless
+						lossless = maptype not in self.lossyMapTypes
+						alpha    = shader["meta"]["diffuseAlpha"] if maptype == "diffuse" else None
+
+						maps[source] = (target, lossless, alpha, list())
+
+					maps[source][3].append((setname, shadername, maptype))
+
+		with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+			futures  = dict()
+			previous = dict() # source path -> path of the file transcoded in an earlier run
+
+			for source, (target, lossless, alpha, _) in maps.items():
+				signature = [os.stat(source).st_mtime_ns, target, format, lossless, alpha, maxSize, powerOfTwo,
+				             self.transcodeVersion]
+
+				if source in manifest and manifest[source][0] == signature and os.path.isfile(manifest[source][1]):
+					continue
+
+				previous[source] = manifest.get(source, [None, None])[1]
+				manifest[source] = [signature, None]
+				futures[source]  = pool.submit(self.transcodeMap, source, target, format, lossless,
+				                               maxSize, powerOfTwo, alpha)
+
+			for source, future in futures.items():
+				manifest[source][1] = future.result()
+				self.debug("Transcoded "+source+" to "+manifest[source][1]+".")
+
+				# remove files of a different format, as the engine could pick them up instead
+				if previous[source] and previous[source] != manifest[source][1] and os.path.isfile(previous[source]):
+					os.remove(previous[source])
+
+		with open(manifestPath, "w") as fp:
+			json.dump(manifest, fp)
+
+		# let the shaders use the transcoded maps
+		for source, (_, _, _, names) in maps.items():
+			for setname, shadername, maptype in names:
+				shader = self.sets[setname][shadername]
+				shader["ext"][maptype] = os.path.splitext(manifest[source][1])[1]
+				shader["abspath"]      = os.path.join(outdir, *shader["relpath"].split("/"))
+
+				self.invalidateShader(setname, shadername)
+
+		self.verbose("Transcoded "+str(len(futures))+" maps, "+str(len(maps) - len(futures))+" were up to date.")
+
+
+	@staticmethod
+	def readMapHeader(path):
+		"Returns the size and mode of a map by reading its header only, or the error message if it can't be read."
+		try:
+			with Image.open(path, "r") as img:
+				return img.size, img.mode, None
+		except Exception as error:
+			return None, None, str(error)
+
+
+	def validateMaps(self, threads = 16):
+		"Reads the headers of all maps referenced by the shaders using a number of threads, without decoding them, and "
+		"returns a list of problems found. Each problem is a dict with the keys set, shader, type, path, problem "
+		"(unreadable, size mismatch or not power of two) and details."
+		paths = set()
+
+		for shaders in self.sets.values():
+			for shader in shaders.values():
+				for maptype in self.suffixes:
+					if shader.get(maptype):
+						paths.add(shader["abspath"]+os.path.sep+shader[maptype]+shader["ext"][maptype])
+
+		with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+			headers = dict(zip(paths, pool.map(self.readMapHeader, paths)))
+
+		problems = list()
+		reported = set() # (set name, shader name, map type, problem), light variants share their maps
+
+		def report(setname, shader, maptype, path, problem, details):
+			if (setname, shader["name"], maptype, problem) not in reported:
+				reported.add((setname, shader["name"], maptype, problem))
+				problems.append({"set": setname, "shader": shader["name"], "type": maptype, "path": path,
+				                 "problem": problem, "details": details})
+
+		for setname, shaders in self.sets.items():
+			for shader in shaders.values():
+				diffuseSize = None
+
+				for maptype in self.suffixes:
+					if not shader.get(maptype):
+						continue
+
+					path           = shader["abspath"]+os.path.sep+shader[maptype]+shader["ext"][maptype]
+					size, _, error = headers[path]
+
+					if error:
+						report(setname, shader, maptype, path, "unreadable", error)
+						continue
+
+					if size[0] & (size[0] - 1) or size[1] & (size[1] - 1):
+						report(setname, shader, maptype, path, "not power of two", "%dx%d" % size)
+
+					# previews are usually smaller
+					if maptype == "diffuse":
+						diffuseSize = size
+					elif maptype != "preview" and diffuseSize and size != diffuseSize:
+						report(setname, shader, maptype, path, "size mismatch",
+						       "%dx%d, diffuse map is %dx%d" % (size + diffuseSize))
+
+		self.verbose("Validated "+str(len(paths))+" maps, found "+str(len(problems))+" problems.")
+
+		return problems
+
+
+	# schema of the database written by exportDatabase
+	databaseSchema = \
+	"""
+	PRAGMA foreign_keys = ON;
+
+	CREATE TABLE IF NOT EXISTS sets (
+		name     TEXT PRIMARY KEY,
+		hash     TEXT NOT NULL
+	);
+
+	CREATE TABLE IF NOT EXISTS shaders (
+		id       INTEGER PRIMARY KEY,
+		setname  TEXT NOT NULL REFERENCES sets(name) ON DELETE CASCADE,
+		name     TEXT NOT NULL,
+		base     TEXT NOT NULL,
+		relpath  TEXT NOT NULL,
+		abspath  TEXT NOT NULL,
+		UNIQUE (setname, name)
+	);
+
+	CREATE TABLE IF NOT EXISTS maps (
+		shader   INTEGER NOT NULL REFERENCES shaders(id) ON DELETE CASCADE,
+		type     TEXT NOT NULL,
+		path     TEXT NOT NULL,
+		file     TEXT NOT NULL
+	);
+
+	CREATE TABLE IF NOT EXISTS meta (
+		shader   INTEGER NOT NULL REFERENCES shaders(id) ON DELETE CASCADE,
+		key      TEXT NOT NULL,
+		value
+	);
+
+	CREATE TABLE IF NOT EXISTS keywords (
+		shader   INTEGER NOT NULL REFERENCES shaders(id) ON DELETE CASCADE,
+		key      TEXT NOT NULL,
+		value    TEXT
+	);
+
+	CREATE TABLE IF NOT EXISTS lights (
+		shader   INTEGER NOT NULL REFERENCES shaders(id) ON DELETE CASCADE,
+		intensity INTEGER NOT NULL,
+		r        INTEGER,
+		g        INTEGER,
+		b        INTEGER
+	);
+
+	CREATE INDEX IF NOT EXISTS shadersBase    ON shaders  (setname, base);
+	CREATE INDEX IF NOT EXISTS mapsShader     ON maps     (shader);
+	CREATE INDEX IF NOT EXISTS mapsPath       ON maps     (path, type);
+	CREATE INDEX IF NOT EXISTS metaShader     ON meta     (shader);
+	CREATE INDEX IF NOT EXISTS metaKey        ON meta     (key, value);
+	CREATE INDEX IF NOT EXISTS keywordsShader ON keywords (shader);
+	CREATE INDEX IF NOT EXISTS keywordsKey    ON keywords (key, value);
+	CREATE INDEX IF NOT EXISTS lightsShader   ON lights   (shader);
+	"""
+
+
+	def exportDatabase(self, path):
+		"Writes all shader data into a SQLite database so that it can be queried by other tools. Sets whose data hasn't "
+		"changed since the last export are left alone."
+		db = sqlite3.connect(path)
+
+		try:
+			db.executescript(self.databaseSchema)
+
+			with db:
+				for setname, shaders in self.sets.items():
+					digest = hashlib.sha1(json.dumps(shaders, sort_keys = True, default = sorted).encode()).hexdigest()
+
+					if db.execute("SELECT 1 FROM sets WHERE name = ? AND hash = ?", (setname, digest)).fetchone():
+						self.debug(setname+": Database is up to date.")
+						continue
+
+					db.execute("DELETE FROM sets WHERE name = ?", (setname, ))
+					db.execute("INSERT INTO sets VALUES (?, ?)", (setname, digest))
+
+					for shadername, shader in shaders.items():
+						self.__exportShader(db, setname, shadername, shader)
+
+					self.verbose(setname+": Exported "+str(len(shaders))+" shaders to "+path+".")
+		finally:
+			db.close()
+
+
+	def __exportShader(self, db, setname, shadername, shader):
+		"Inserts a single shader into a database."
+		shaderId = db.execute("INSERT INTO shaders (setname, name, base, relpath, abspath) VALUES (?, ?, ?, ?, ?)",
+		                      (setname, shadername, shader["name"], shader["relpath"], shader["abspath"])).lastrowid
+
+		for maptype in self.suffixes:
+			if shader.get(maptype):
+				db.execute("INSERT INTO maps VALUES (?, ?, ?, ?)",
+				           (shaderId, maptype, shader["relpath"]+"/"+shader[maptype],
+				            shader["abspath"]+os.path.sep+shader[maptype]+shader["ext"][maptype]))
+
+		for key, value in shader["meta"].items():
+			if type(value) not in (bool, int, float, str):
+				value = json.dumps(value, sort_keys = True)
+
+			db.execute("INSERT INTO meta VALUES (?, ?, ?)", (shaderId, key, value))
+
+		for key, value in shader.get("keywords", dict()).items():
+			if type(value) != str and hasattr(value, "__iter__"):
+				for value in value:
+					db.execute("INSERT INTO keywords VALUES (?, ?, ?)", (shaderId, key, str(value)))
+			else:
+				db.execute("INSERT INTO keywords VALUES (?, ?, ?)", (shaderId, key, value))
+
+		if "lightIntensity" in shader["meta"]:
+			color = shader["meta"].get("lightColor", dict())
+
+			db.execute("INSERT INTO lights VALUES (?, ?, ?, ?, ?)",
+			           (shaderId, shader["meta"]["lightIntensity"], color.get("r"), color.get("g"), color.get("b")))
+
+
+	def __radToAdd(self, shader, r, g = None, b = None):
+		"Given light colors, return modified colors to be used in the blend phase of the addition map."
+		exp = shader["options"]["radToAddExp"]
+
+		if g and b:
+			return (r**exp, g**exp, b**exp)
+		else:
+			return r**exp
+
+
+	def __renderShader(self, setname, shadername, renderer = None, compact = None):
+		"Returns the definition of a single shader. If a renderer is given, it replaces the shader's renderer option. "
+		"compact overrides the compact output option. The definition is only assembled if the shader has been "
+		"replaced or invalidated since it was last rendered."
+		shader   = self.sets[setname][shadername]
+		renderer = renderer or shader["options"]["renderer"]
+		compact  = self.compactOutput if compact == None else compact
+		key      = (setname, shadername, renderer, compact)
+
+		cached = self.renderCache.get(key)
+
+		if cached and cached[0] is shader:
+			return cached[1]
+
+		content = self.__assembleShader(setname, shadername, shader, renderer)
+
+		# keywords and their arguments need to stay on one line
+		if compact:
+			content = "".join(" ".join(line.split())+"\n" for line in content.splitlines() if line and not line.isspace())
+
+		self.renderCache[key] = (shader, content)
+
+		return content
+
+
+	def invalidateShader(self, setname, shadername = None):
+		"Forgets about the rendered definition of a shader, or of all shaders in a set if no shader name is given. "
+		"Needs to be called after modifying shader data in place."
+		for key in list(self.renderCache):
+			if key[0] == setname and (not shadername or key[1] == shadername):
+				self.renderCache.pop(key, None)
+
+
+	def __assembleShader(self, setname, shadername, shader, renderer):
+		"Assembles and returns the definition of a single shader."
+		# prepare content
+		path = shader["relpath"]+"/"
+
+		# decide on a preview image
+		if shader["preview"]:
+			preview = shader["preview"]
+		elif shader["diffuse"]:
+			preview = shader["diffuse"]
+		else:
+			preview = None
+
+		# extract light color if available
+		if "lightColor" in shader["meta"]:
+			r = shader["meta"]["lightColor"]["r"] / 0xff
+			g = shader["meta"]["lightColor"]["g"] / 0xff
+			b = shader["meta"]["lightColor"]["b"] / 0xff
+
+		content = setname+"/"+shadername+"\n{\n"
+
+		# preview image
+		if preview:
+			content += "\tqer_editorImage     "+path+preview+"\n"
+
+			# in-editor transparency
+			if shader["meta"]["diffuseAlpha"] and shader["options"]["editorOpacity"] < 1:
+				content += "\tqer_trans           "+"%.2f"%shader["options"]["editorOpacity"]+"\n"
+
+			content += "\n"
+
+		# keywords
+		if "keywords" in shader and len(shader["keywords"]) > 0:
+			for key, value in sorted(shader["keywords"].items()):
+				if type(value) != str and hasattr(value, "__iter__"):
+					for value in sorted(value):
+						content += "\t"+key+" "*max(1, 20-len(key))+str(value)+"\n"
+				elif value == None:
+					content += "\t"+key+"\n"
+				else:
+					content += "\t"+key+" "*max(1, 20-len(key))+str(value)+"\n"
+
+			content += "\n"
+
+		# surface light
+		if "lightIntensity" in shader["meta"] and shader["meta"]["lightIntensity"] > 0:
+			# intensity
+			content += "\tq3map_surfacelight  "+"%d" % shader["meta"]["lightIntensity"]+"\n"
+
+			# color
+			if "lightColor" in shader["meta"]:
+				content += "\tq3map_lightRGB      "+"%.3f %.3f %.3f" % (r, g, b)+"\n\n"
+			elif "additionAverage" in shader["meta"]:
+				content += "\tq3map_lightRGB      "+"%.3f %.3f %.3f" % shader["meta"]["additionAverage"]+"\n\n"
+			elif shader["addition"]:
+				content += "\tq3map_lightImage    "+shader["addition"]+"\n\n"
+			elif shader["diffuse"]:
+				content += "\tq3map_lightImage    "+shader["diffuse"]+"\n\n"
+			else:
+				content += "\tq3map_lightRGB      1.000 1.000 1.000\n\n"
+
+		# diffuse map
+		if shader["diffuse"]:
+
+			# with alpha channel
+			if shader["meta"]["diffuseAlpha"]:
+				content += "\t{\n"+\
+				           "\t\tmap       "+path+shader["diffuse"]+"\n"
+
+				if renderer != "quake3":
+					content += "\t\tstage     diffuseMap\n"
+
+				# alphatest forced
+				if shader["options"]["alphaTest"]:
+					if type(shader["options"]["alphaTest"]) == str:
+						content += "\t\talphaFunc "+shader["options"]["alphaTest"]+"\n"
+					else:
+						content += "\t\talphaTest "+"%.2f"%shader["options"]["alphaTest"]+"\n"
+
+				# alphatest implied by binary alpha values
+				elif shader["meta"]["diffuseAlphaBin"]:
+					content += "\t\talphaFunc GE128\n"
+
+				# smooth blending
+				else:
+					content += "\t\tblend     blend\n"
+
+				content += "\t}\n"
+
+			# without alpha channel
+			elif renderer != "quake3":
+				content += "\tdiffuseMap          "+path+shader["diffuse"]+"\n"
+			else:
+				content += "\t{\n"+\
+				           "\t\tmap   "+path+shader["diffuse"]+"\n"+\
+				           "\t}\n"
+
+		# normal & height map
+		if renderer != "quake3":
+			if shader["normal"]:
+				if shader["height"] and shader["options"]["heightNormalsMod"] > 0:
+					content += "\tnormalMap           addnormals ( "+path+shader["normal"]+\
+							   ", heightmap ( "+path+shader["height"]+", "+\
+							   "%.2f" % shader["options"]["heightNormalsMod"]+" ) )\n"
+				else:
+					content += "\tnormalMap           "+path+shader["normal"]+"\n"
+			elif shader["height"] and shader["options"]["heightNormalsMod"] > 0:
+				content += "\tnormalMap           heightmap ( "+path+shader["height"]+", "+\
+						   "%.2f" % shader["options"]["heightNormalsMod"]+" )\n"
+
+		# specular map
+		if renderer != "quake3":
+			if shader["specular"]:
+				content += "\tspecularMap         "+path+shader["specular"]+"\n"
+
+		# addition map
+		if shader["addition"]:
+			if renderer == "daemon" \
+			and ("lightColor" not in shader["meta"] or r == b == g == 1.0):
+				content += "\tglowMap             "+path+shader["addition"]+"\n"
+			else:
+				content += "\t{\n"+\
+				           "\t\tmap   "+path+shader["addition"]+"\n"+\
+				           "\t\tblend add\n"
+				if "lightColor" in shader["meta"] and r + g + b < 3.0:
+					content += \
+					       "\t\tred   "+"%.3f" % self.__radToAdd(shader, r)+"\n"+\
+					       "\t\tgreen "+"%.3f" % self.__radToAdd(shader, g)+"\n"+\
+					       "\t\tblue  "+"%.3f" % self.__radToAdd(shader, b)+"\n"
+				content += "\t}\n"
+
+		content += "}\n"
+
+		return content
+
+
+	def __renderHeader(self):
+		"Returns the header as comment lines."
+		if self.renderedHeader[0] is not self.header:
+			content = ""
+
+			for line in self.header.splitlines():
+				if line.startswith("//"):
+					content += line+"\n"
+				else:
+					content += "// "+line+"\n"
+
+			self.renderedHeader = (self.header, content)
+
+		return self.renderedHeader[1]
+
+
+	def __redundantShaders(self, setname, renderer, compact):
+		"Returns the names of light variants in a set whose definition, apart from the name, is identical to that of "
+		"another variant of the same texture. The not glowing version is preferred over the others."
+		shaders     = self.sets[setname]
+		definitions = dict() # definition without name -> name of the shader that is kept
+		redundant   = set()
+
+		for name in sorted(shaders, key = lambda name: ("lightIntensity" in shaders[name]["meta"], name)):
+			definition = self.__renderShader(setname, name, renderer, compact).split("\n", 1)[1]
+
+			if definition in definitions:
+				redundant.add(name)
+				self.debug("Leaving out "+setname+"/"+name+", identical to "+setname+"/"+definitions[definition]+".")
+			else:
+				definitions[definition] = name
+
+		return redundant
+
+
+	def getShader(self, setname = None, shadername = None, renderer = None, compact = None):
+		"Assembles and returns the shader file content. If a renderer is given, it is used for all shaders instead of "
+		"their renderer option. compact overrides the compact output option."
+		compact = self.compactOutput if compact == None else compact
+		content = [self.__renderHeader()]
+
+		if setname:
+			if setname in self.sets:
+				setnames = (setname, )
+			else:
+				self.error("Unknown set "+str(setname)+".")
+				return
+		else:
+			setnames = list(self.sets)
+
+		for setname in setnames:
+			if shadername:
+				if shadername in self.sets[setname]:
+					names = (shadername, )
+				else:
+					continue
+			elif compact:
+				redundant = self.__redundantShaders(setname, renderer, compact)
+				names     = sorted(name for name in self.sets[setname] if name not in redundant)
+			else:
+				content.append("\n"+\
+				               "// "+"-"*len(setname)+"\n"+\
+				               "// "+setname+"\n"+\
+				               "// "+"-"*len(setname)+"\n")
+
+				names = sorted(self.sets[setname].keys())
+
+			for name in names:
+				if not compact:
+					content.append("\n")
+
+				content.append(self.__renderShader(setname, name, renderer, compact))
+
+		return "".join(content)
+
+
+	def compareOutputFormats(self, renderer = None):
+		"Reports the size and emission time of the compact output format compared to the default one."
+		results = dict() # compact -> (size, seconds)
+
+		for compact in (False, True):
+			self.renderCache.clear()
+
+			start   = time.perf_counter()
+			size    = len(self.getShader(renderer = renderer, compact = compact).encode())
+			results[compact] = (size, time.perf_counter() - start)
+
+		self.verbose("Default output: "+str(results[False][0])+" bytes in "+"%.3f" % results[False][1]+" s, compact "
+		             "output: "+str(results[True][0])+" bytes in "+"%.3f" % results[True][1]+" s ("+
+		             "%.1f" % (100 - 100 * results[True][0] / max(1, results[False][0]))+"% smaller).")
+
+
+	def writeShaders(self, outputs):
+		"Writes a shader file for each of multiple renderers, given a mapping from renderer names to destination paths. "
+		"The shader data is shared, only the rendering is done once per renderer. All files are written concurrently."
+		for renderer in outputs:
+			if renderer not in self.supportedRenderers:
+				self.error("Renderer "+renderer+" not supported. Supported renderers are "+str(self.supportedRenderers)+".")
+				return
+
+		def write(renderer, path):
+			with open(path, "w") as fp:
+				fp.write(self.getShader(renderer = renderer))
+
+			self.verbose("Wrote "+renderer+" shaders to "+path+".")
+
+		with concurrent.futures.ThreadPoolExecutor(len(outputs)) as pool:
+			for future in [pool.submit(write, renderer, path) for renderer, path in outputs.items()]:
+				future.result()
+
+
+	def mergeShader(self, shaderFile, adopt = False):
+		"Merges all shaders into a ShaderFile. Definitions that Sloth writes are marked with a hash of their text. A "
+		"definition is only replaced if it differs from the new one and still matches its hash, so definitions that "
+		"have been edited by hand are kept. Unmarked definitions, such as those written by earlier versions of Sloth, "
+		"count as edited by hand unless adopt is given, then they are replaced if they differ. Definitions that don't "
+		"change are kept as they are. Returns the new file content."
+		kept = updated = added = 0
+		edited = list() # names of definitions edited by hand and kept
+
+		for setname in list(self.sets):
+			for shadername in sorted(self.sets[setname]):
+				name   = setname+"/"+shadername
+				text   = self.__renderShader(setname, shadername).rstrip("\n")
+				digest = ShaderFile.digest(text)
+
+				if name not in shaderFile.shaders:
+					shaderFile.add(name, ShaderFile.stamp(text, digest))
+					added += 1
+					continue
+
+				recorded, current = ShaderFile.unstamp(shaderFile[shaderFile.shaders[name]][1])
+
+				if recorded == digest or current == text:
+					kept += 1
+				elif ( recorded and ShaderFile.digest(current) == recorded ) or ( adopt and not recorded ):
+					shaderFile.replace(name, ShaderFile.stamp(text, digest))
+					updated += 1
+				else:
+					edited.append(name)
+
+		self.verbose("Merged shaders: "+str(kept)+" kept, "+str(updated)+" updated, "+str(added)+" added, "+
+		             str(len(edited))+" edited by hand and kept.")
+
+		if edited:
+			self.verbose("Kept shaders edited by hand"+("" if adopt else " or written without a mark")+": "+
+			             ", ".join(edited))
+
+		return shaderFile.getText()
+
+
+	# extensions of map formats that are compressed already and are stored in packages as they are
+	storedExtensions = (".jpg", ".jpeg", ".png", ".webp", ".crn")
+
+
+	@staticmethod
+	def __packMember(name, data, date, method, previous):
+		"Returns the arguments to ZipWriter.add for a package member. previous is a tuple of the members of an earlier "
+		"package by name, an open file of it and a lock for that file. If its member of the same name has the same "
+		"content it is copied instead of being compressed again."
+		if type(data) != bytes:
+			with open(data, "rb") as fp:
+				data = fp.read()
+
+		crc = zlib.crc32(data)
+
+		if previous:
+			infos, fp, lock = previous
+			info            = infos.get(name)
+
+			if info and info.CRC == crc and info.file_size == len(data) and info.compress_type == method:
+				with lock:
+					raw = ZipWriter.readRaw(fp, info)
+
+				return name, method, crc, len(data), raw, info.date_time, True
+
+		if method == zipfile.ZIP_DEFLATED:
+			compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+			compressed = compressor.compress(data) + compressor.flush()
+		else:
+			compressed = data
+
+		return name, method, crc, len(data), compressed, date, False
+
+
+	def writePackage(self, path, renderer = None, shaderName = None, jobs = None):
+		"Writes a pk3 package with the shader file as scripts/shaderName.shader and all maps referenced by the shaders, "
+		"compressing them with up to jobs threads. Formats that are compressed already are stored. If the package "
+		"exists, its members are reused where the content didn't change. Returns the number of reused members."
+		shaderName = shaderName or os.path.splitext(os.path.basename(path))[0]
+		members    = dict() # member name -> path or content
+		previous   = None   # (member name -> ZipInfo, open file, lock) of the existing package
+		temporary  = path+".tmp"
+		reused     = 0
+
+		if os.path.isfile(path) and zipfile.is_zipfile(path):
+			with zipfile.ZipFile(path, "r") as archive:
+				previous = ({info.filename: info for info in archive.infolist()}, open(path, "rb"), threading.Lock())
+
+		members["scripts/"+shaderName+".shader"] = self.getShader(renderer = renderer).encode()
+
+		for shaders in self.sets.values():
+			for shader in shaders.values():
+				for maptype in self.suffixes:
+					if shader.get(maptype):
+						name = shader["relpath"]+"/"+shader[maptype]+shader["ext"][maptype]
+						members[name] = shader["abspath"]+os.path.sep+shader[maptype]+shader["ext"][maptype]
+
+		def pack(name, data):
+			date = time.localtime(None if type(data) == bytes else os.path.getmtime(data))[:6]
+
+			method = zipfile.ZIP_STORED if name.lower().endswith(self.storedExtensions) else zipfile.ZIP_DEFLATED
+
+			return self.__packMember(name, data, date, method, previous)
+
+		try:
+			# keep a limited number of compressed members in memory while writing them in order
+			with concurrent.futures.ThreadPoolExecutor(jobs) as pool, open(temporary, "wb") as fp:
+				writer  = ZipWriter(fp)
+				pending = collections.deque()
+				window  = 2 * (jobs or os.cpu_count() or 1)
+
+				for name, data in members.items():
+					pending.append(pool.submit(pack, name, data))
+
+					while pending and (len(pending) > window or pending[0].done()):
+						*member, wasReused = pending.popleft().result()
+						writer.add(*member)
+						reused += wasReused
+
+				while pending:
+					*member, wasReused = pending.popleft().result()
+					writer.add(*member)
+					reused += wasReused
+
+				writer.close()
+		finally:
+			if previous:
+				previous[1].close()
+
+		os.replace(temporary, path)
+
+		self.verbose("Wrote "+str(len(members))+" files to "+path+", "+str(reused)+" were reused from the previous "
+		             "package.")
+
+		return reused
+
+
+class ShaderFile(list):
+	"A parsed shader file. It is a list of (shader name, text) pieces that concatenate to the original file content, "
+	"where the name is None for text between shader definitions, such as comments."
+
+	# comments, quoted strings, braces and other tokens
+	tokenRE = re.compile(r'//[^\n]*|/\*.*?\*/|"[^"]*"|[{}]|[^\s{}"]+', re.S)
+
+	# comment that marks a definition written by Sloth with a hash of it
+	stampRE = re.compile(r"\n[ \t]*// sloth ([0-9a-f]{16})[ \t]*(?=\n)")
+
+
+	def __init__(self, text = ""):
+		list.__init__(self)
+		self.shaders = dict() # shader name -> index of its piece
+
+		self.parse(text)
+
+
+	def parse(self, text):
+		"Splits shader file content into pieces."
+		self.clear()
+		self.shaders.clear()
+
+		depth = 0    # brace nesting level
+		name  = None # name token of the current shader
+		start = 0    # end of the last piece
+
+		for token in self.tokenRE.finditer(text):
+			value = token.group()
+
+			if value.startswith("//") or value.startswith("/*"):
+				continue
+			elif value == "{":
+				depth += 1
+			elif value == "}":
+				depth -= 1
+
+				if depth == 0 and name:
+					if name.start() > start:
+						self.append((None, text[start:name.start()]))
+
+					self.shaders[name.group()] = len(self)
+					self.append((name.group(), text[name.start():token.end()]))
+
+					start = token.end()
+					name  = None
+			elif depth == 0:
+				name = token
+
+		if start < len(text):
+			self.append((None, text[start:]))
+
+
+	def getText(self):
+		"Returns the (modified) file content."
+		return "".join(text for _, text in self)
+
+
+	def replace(self, name, text):
+		"Replaces the definition of a shader."
+		self[self.shaders[name]] = (name, text)
+
+
+	def add(self, name, text):
+		"Adds a shader definition after the last shader that shares the name's path, or at the end of the file."
+		prefix  = name.rsplit("/", 1)[0]+"/"
+		indices = [index for otherName, index in self.shaders.items() if otherName.startswith(prefix)]
+
+		if indices:
+			index = max(indices) + 1
+			piece = [(None, "\n\n"), (name, text.rstrip("\n"))]
+		else:
+			index = len(self)
+			piece = [(None, "\n"), (name, text.rstrip("\n")), (None, "\n")]
+
+		self[index:index] = piece
+
+		for otherName in self.shaders:
+			if self.shaders[otherName] >= index:
+				self.shaders[otherName] += len(piece)
+
+		self.shaders[name] = index + 1
+
+
+	@staticmethod
+	def digest(text):
+		"Returns the hash used to mark a shader definition."
+		return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+	@classmethod
+	def stamp(cls, text, digest):
+		"Returns a shader definition with a comment holding its hash as the first line of its body."
+		return text.replace("{\n", "{\n\t// sloth "+digest+"\n", 1)
+
+
+	@classmethod
+	def unstamp(cls, text):
+		"Returns the hash a shader definition has been marked with, or None, and the definition without the mark."
+		match = cls.stampRE.search(text)
+
+		if not match:
+			return None, text
+
+		return match.group(1), text[:match.start()] + text[match.end():]
+
+
+class KeywordMatcher:
+	"Finds all words of a dictionary that occur in a text with a single pass over the text, using the Aho-Corasick "
+	"algorithm. The time needed doesn't depend on the size of the dictionary."
+
+	def __init__(self):
+		self.goto     = [dict()] # state -> character -> next state
+		self.fail     = [0]      # state -> state for the longest proper suffix that is also in the trie
+		self.output   = [set()]  # state -> results of all words ending in this state
+		self.compiled = True
+		self.lock     = threading.Lock() # held while changing the trie
+
+
+	def add(self, word, result):
+		"Adds a word to the dictionary. match returns result if the word is found."
+		if not word:
+			return
+
+		with self.lock:
+			state = 0
+
+			for char in word:
+				if char not in self.goto[state]:
+					self.goto.append(dict())
+					self.fail.append(0)
+					self.output.append(set())
+					self.goto[state][char] = len(self.goto) - 1
+
+				state = self.goto[state][char]
+
+			self.output[state].add(result)
+			self.compiled = False
+
+
+	def compile(self):
+		"Computes the failure transitions. Called by match as needed."
+		queue = list(self.goto[0].values())
+
+		for state in queue:
+			self.fail[state] = 0
+
+		for state in queue:
+			for char, nextState in self.goto[state].items():
+				queue.append(nextState)
+
+				fail = self.fail[state]
+				while fail and char not in self.goto[fail]:
+					fail = self.fail[fail]
+
+				self.fail[nextState] = self.goto[fail].get(char, 0)
+				self.output[nextState] |= self.output[self.fail[nextState]]
+
+		self.compiled = True
+
+
+	def match(self, text):
+		"Returns the results of all words that occur in the text."
+		if not self.compiled:
+			with self.lock:
+				if not self.compiled:
+					self.compile()
+
+		goto    = self.goto
+		fail    = self.fail
+		output  = self.output
+		state   = 0
+		results = set()
+
+		for char in text:
+			while state and char not in goto[state]:
+				state = fail[state]
+
+			state = goto[state].get(char, 0)
+
+			if output[state]:
+				results |= output[state]
+
+		return results
+
+
+class ZipWriter:
+	"Writes a zip archive from members that have been compressed already, so that they can be compressed in parallel "
+	"or copied from another archive without compressing them again."
+
+	localHeader  = struct.Struct("<4s2B4HL2L2H")
+	centralEntry = struct.Struct("<4s4B4HL2L5H2L")
+	endRecord    = struct.Struct("<4s4H2LH")
+
+	# range of dates that can be stored in zip archives
+	firstDate = (1980, 1, 1, 0, 0, 0)
+	lastDate  = (2107, 12, 31, 23, 59, 58)
+
+	def __init__(self, fp):
+		self.fp      = fp
+		self.entries = list() # central directory entries
+
+
+	@classmethod
+	def readRaw(cls, fp, info):
+		"Returns the compressed data of a member of a zipfile.ZipFile, given its file object and the ZipInfo."
+		fp.seek(info.header_offset)
+		header = cls.localHeader.unpack(fp.read(cls.localHeader.size))
+		fp.seek(header[10] + header[11], os.SEEK_CUR)
+
+		return fp.read(info.compress_size)
+
+
+	def add(self, name, method, crc, size, data, date):
+		"Writes a member. data is the compressed content, size the uncompressed size and date a tuple of year, month, "
+		"day, hour, minute and second, which is clamped to the range of zip dates."
+		date    = min(max(tuple(date[:6]), self.firstDate), self.lastDate)
+		offset  = self.fp.tell()
+		name    = name.encode()
+		flags   = 0x800 if not name.isascii() else 0 # UTF-8 name
+		dosTime = date[3] << 11 | date[4] << 5 | date[5] // 2
+		dosDate = (date[0] - 1980) << 9 | date[1] << 5 | date[2]
+
+		if offset > 0xffffffff or len(data) > 0xffffffff or size > 0xffffffff or len(self.entries) >= 0xffff:
+			raise ValueError("Archive too large, ZIP64 isn't supported.")
+
+		self.fp.write(self.localHeader.pack(b"PK\003\004", 20, 0, flags, method, dosTime, dosDate, crc,
+		                                    len(data), size, len(name), 0))
+		self.fp.write(name)
+		self.fp.write(data)
+
+		self.entries.append(self.centralEntry.pack(b"PK\001\002", 20, 3, 20, 0, flags, method, dosTime, dosDate, crc,
+		                                           len(data), size, len(name), 0, 0, 0, 0, 0o644 << 16, offset) + name)
+
+
+	def close(self):
+		"Writes the central directory."
+		offset = self.fp.tell()
+
+		for entry in self.entries:
+			self.fp.write(entry)
+
+		self.fp.write(self.endRecord.pack(b"PK\005\006", 0, 0, len(self.entries), len(self.entries),
+		                                  self.fp.tell() - offset, offset, 0))
+
+
+class ExampleConfig(argparse.Action):
+	example = \
+"""
+# This is a per-directory/shader configuration file for Sloth.
+#
+# Sloth is a Python tool that generates XreaL/Daemon shader files from
+# directories of texture maps. Sloth is free software and can be found at
+# https://github.com/Unvanquished/Sloth
+#
+# The command line arguments used to invoke Sloth are global defaults for all
+# shaders. They can be changed on a per-directory level by putting a file
+# named "options.sloth" in the texture source folder. Other files ending in
+# ".sloth" are read when their basename forms the beginning of the shader name
+# in question. It is possible to have multiple sloth files overlay each other
+# in a hierarchical order, for example one named "metal.sloth" that adds the
+# "metalsteps" surface parameter to every shader starting with "metal" and one
+# named "metaleatingbacteria.sloth" that removes it and adds the "flesh"
+# surfaceparm instead for shaders starting with the respective string.
+#
+# An example configuration can be generated with the -e/--example-config
+# argument. Be aware that sloth files are case-sensitive.
+
+# The "options" section contains mostly keywords that correspond to command
+# line options. For a detailed description of their function invoke Sloth with
+# the -h/--help option.
+[options]
+# Corresponds to --colors
+#colors = red:ff0000 green:00ff00
+
+# Like "colors" but doesn't clear previous values
+#addColors = blue:0000ff white:ffffff
+
+# Corresponds to --custom-lights
+#customLights = 1000 2000
+
+# Like "customLights" but doesn't clear previous values
+#addCustomLights = 3000 4000
+
+# Corresponds to --predef-lights
+#predefLights = 100 200
+
+# Corresponds to --precalc-colors
+#precalcColors = on
+
+# Like "predefLights" but doesn't clear previous values
+#addPredefLights = 300 400
+
+# Corresponds to --color-blend-exp
+#colorBlendExp = 1.2
+
+# Correspond to --gt0, --ge128 and --lt128, respectively
+#alphaFunc = GT0
+#alphaFunc = GE128
+#alphaFunc = LT128
+
+# Corresponds to --alpha-test
+#alphaTest = 0.5
+
+# Value "off" corresponds to --no-alpha-shadows
+#alphaShadows = off
 
 # Corresponds to --height-normals
 #heightNormalsMod = 0.8
@@ -954,12 +2965,16 @@ if __name__ == "__main__":
 	p.add_argument("-f", "--config", metavar="FILE", type=argparse.FileType("r"),
 	               help="Read global configuration (takes precedence over command line arguments)")
 
-	p.add_argument("pathes", metavar="PATH", nargs="+",
+	p.add_argument("pathes", metavar="PATH", nargs="*",
 	               help="Path to a source directory that should be added to the set")
 
 	p.add_argument("-g", "--guess", action="store_true",
 	               help="Guess additional keywords based on shader (meta)data")
 
+	p.add_argument("--guess-words", metavar="FILE", type=argparse.FileType("r"), action="append",
+	               help="Read additional words for keyword guessing from a file. Each section names a keyword and "
+	                    "maps its values to trigger words, e.g. \"[surfaceparm]\" followed by \"metalsteps = metal steel\".")
+
 	p.add_argument("--height-normals", metavar="VALUE", type=float, default=1.0,
 	               help="Modifier used for generating normals from a heightmap")
 
@@ -1042,11 +3057,113 @@ if __name__ == "__main__":
 	g.add_argument("-t", "--header", metavar="FILE", type=argparse.FileType("r"),
 	               help="Use file content as a header, \"// \" will be prepended to each line")
 
-	g.add_argument("-o", "--out", metavar="DEST", type=argparse.FileType("w"),
+	gm = g.add_mutually_exclusive_group()
+
+	gm.add_argument("-o", "--out", metavar="DEST", type=argparse.FileType("w"),
 	               help="Write shader to this file")
 
+	gm.add_argument("-m", "--merge", metavar="DEST",
+	               help="Merge shaders into this file, creating it if needed. Definitions that changed are replaced "
+	                    "unless they have been edited by hand since Sloth wrote them, others are kept as they are")
+
+	g.add_argument("--adopt", action="store_true",
+	               help="With -m, also replace changed definitions that Sloth hasn't marked, such as those written by "
+	                    "earlier versions")
+
+	gm.add_argument("--renderer-out", metavar="RENDERER:DEST", action="append",
+	               help="Write a shader file for the given renderer, e.g. daemon:scripts/set.shader. "
+	                    "Can be supplied multiple times, maps are only analysed once for all renderers.")
+
+	g.add_argument("--compact", action="store_true",
+	               help="Write shaders with minimal whitespace, no comments other than the header and without light "
+	                    "variants that are identical to another variant of the same texture")
+
+	g.add_argument("--save-snapshot", metavar="FILE",
+	               help="Save the generated shader data to FILE, so that it can be written again without analysing the maps")
+
+	g.add_argument("--load-snapshot", metavar="FILE",
+	               help="Use shader data saved with --save-snapshot instead of reading source directories")
+
+	g.add_argument("--previews", metavar="SIZE", type=int,
+	               help="Generate preview images of at most SIZE pixels for shaders without one, next to the diffuse maps")
+
+	g.add_argument("--bake-normals", action="store_true",
+	               help="Compute normal maps from height maps (see --height-normals) once instead of at every level load. "
+	                    "They are written to a \"baked\" subfolder of the source directory.")
+
+	g.add_argument("--validate", metavar="FILE",
+	               help="Check the dimensions of all referenced maps and write problems found to FILE as JSON")
+
+	g.add_argument("--package", metavar="FILE",
+	               help="Write the shaders and all referenced maps to this pk3, reusing unchanged files if it exists")
+
+	g.add_argument("--database", metavar="FILE",
+	               help="Export shader data to this SQLite database, only updating sets that changed")
+
+	# Map analysis
+	g = p.add_argument_group("Map analysis")
+
+	g.add_argument("-j", "--jobs", metavar="N", type=int,
+	               help="Read and analyse maps concurrently, using N worker processes for the analysis")
+
+	g.add_argument("--map-cache", metavar="FILE",
+	               help="Store map metadata in this file so that unchanged maps aren't analysed again in later runs")
+
+	g.add_argument("--tile-rows", metavar="N", type=int,
+	               help="Analyse maps in strips of N rows to bound memory usage, report peak memory use per map")
+
+	g.add_argument("--approximate", metavar="ERROR", type=float,
+	               help="Analyse a sample of large maps first, allowing this error in colors precalculated from uncompressed maps")
+
+	g.add_argument("--max-memory", metavar="MIB", type=int,
+	               help="Analyse maps concurrently while their estimated memory usage fits into MIB, largest first within "
+	                    "windows of maps")
+
+	# Sharding
+	g = p.add_argument_group("Sharding")
+	gm = g.add_mutually_exclusive_group()
+
+	gm.add_argument("--shard", metavar=("I/N", "FILE"), nargs=2,
+	               help="Only generate the I-th of N parts of the shaders (counting from 0) and save them to FILE "
+	                    "instead of writing shaders")
+
+	gm.add_argument("--merge-shards", metavar="FILE", nargs="+", type=argparse.FileType("r"),
+	               help="Combine the parts saved with --shard instead of reading source directories")
+
+	# Transcoding
+	g = p.add_argument_group("Transcoding")
+
+	g.add_argument("--transcode", metavar="DIR",
+	               help="Convert all referenced maps and write them to DIR, which takes the place of the game directory")
+
+	g.add_argument("--transcode-format", metavar="FORMAT", choices=ShaderGenerator.transcodeFormats, default="jpg",
+	               help="Format of transcoded maps without alpha channel. Normal and height maps stay lossless.")
+
+	g.add_argument("--max-size", metavar="SIZE", type=int,
+	               help="Scale transcoded maps down to at most SIZE pixels in each dimension")
+
+	g.add_argument("--power-of-two", action="store_true",
+	               help="Scale transcoded maps down to power of two dimensions")
+
 	a = p.parse_args()
 
+	if len([source for source in (a.pathes, a.merge_shards, a.load_snapshot) if source]) > 1:
+		p.error("only one of source directories, --merge-shards and --load-snapshot can be given")
+	elif not a.pathes and not a.merge_shards and not a.load_snapshot:
+		p.error("no source directories given")
+
+	if a.adopt and not a.merge:
+		p.error("--adopt can only be used with -m/--merge")
+
+	if a.shard:
+		try:
+			index, count = (int(number) for number in a.shard[0].split("/"))
+		except ValueError:
+			p.error("argument --shard: I/N must be two numbers separated by a slash, not "+a.shard[0])
+
+		if not 0 <= index < count:
+			p.error("argument --shard: I must be at least 0 and less than N")
+
 	# init generator
 	if a.verbose:
 		verbosity = a.verbose
@@ -1071,6 +3188,12 @@ if __name__ == "__main__":
 	sg.setAlphaShadows(not a.no_alpha_shadows)
 	sg.setEditorOpacity(a.editor_opacity)
 	sg.setPrecalcColors(a.precalc_colors)
+	sg.setTiledAnalysis(a.tile_rows)
+	sg.setApproximateAnalysis(a.approximate)
+	sg.setCompactOutput(a.compact)
+
+	if a.shard:
+		sg.setShard(index, count)
 
 	if a.header:
 		sg.setHeader(a.header.read())
@@ -1094,19 +3217,100 @@ if __name__ == "__main__":
 	elif a.lt128:
 		sg.setAlphaTest("LT128")
 
+	for fp in a.guess_words or ():
+		sg.readKeywordDictionary(fp)
+		fp.close()
+
 	# read global configuration
 	if a.config:
 		sg.readConfig(a.config)
 
+	# load map metadata from previous runs
+	if a.map_cache and os.path.isfile(a.map_cache):
+		with open(a.map_cache, "r") as fp:
+			sg.loadMapCache(fp)
+
 	# generate
-	for path in a.pathes:
-		sg.generateSet(path, setname = a.root, cutextension = a.strip)
+	if a.load_snapshot:
+		with open(a.load_snapshot, "rb") as fp:
+			if not sg.loadSnapshot(fp):
+				sys.exit(1)
+	elif a.merge_shards:
+		merged = sg.mergeShards(a.merge_shards)
+
+		for fp in a.merge_shards:
+			fp.close()
+
+		if not merged:
+			sys.exit(1)
+	elif a.jobs or a.max_memory:
+		sg.generateSets(a.pathes, setname = a.root, cutextension = a.strip, jobs = a.jobs,
+		                maxMemory = a.max_memory * 2**20 if a.max_memory else None)
+	else:
+		for path in a.pathes:
+			sg.generateSet(path, setname = a.root, cutextension = a.strip)
+
+	if a.map_cache:
+		with open(a.map_cache, "w") as fp:
+			sg.saveMapCache(fp)
+
+	# leave everything else to the merge
+	if a.shard:
+		with open(a.shard[1], "w") as fp:
+			sg.saveShard(fp)
+
+		sys.exit(0)
+
+	if a.previews:
+		sg.generatePreviews(a.previews, a.jobs)
+
+	if a.bake_normals:
+		sg.bakeNormals(a.jobs)
+
+	if a.transcode:
+		sg.transcodeMaps(a.transcode, a.transcode_format, a.max_size, a.power_of_two, a.jobs)
+
+	if a.validate:
+		problems = sg.validateMaps()
+
+		for problem in problems:
+			sg.error(problem["path"]+": "+problem["problem"]+" ("+problem["details"]+")")
+
+		with open(a.validate, "w") as fp:
+			json.dump(problems, fp, indent = "\t")
+
+	if a.database:
+		sg.exportDatabase(a.database)
+
+	if a.package:
+		sg.writePackage(a.package, jobs = a.jobs)
+
+	if a.save_snapshot:
+		with open(a.save_snapshot, "wb") as fp:
+			sg.saveSnapshot(fp)
+
+	if a.compact and a.verbose:
+		sg.compareOutputFormats()
 
 	# output
-	shader = sg.getShader()
+	if a.renderer_out:
+		sg.writeShaders(dict(item.split(":", 1) for item in a.renderer_out))
+	elif a.merge:
+		shaderFile = ShaderFile()
+
+		if os.path.isfile(a.merge):
+			with open(a.merge, "r") as fp:
+				shaderFile.parse(fp.read())
+		else:
+			sg.verbose("Creating "+a.merge+".")
 
-	if a.out:
-		a.out.write(shader)
-		a.out.close()
+		with open(a.merge, "w") as fp:
+			fp.write(sg.mergeShader(shaderFile, a.adopt))
 	else:
-		print(shader)
+		shader = sg.getShader()
+
+		if a.out:
+			a.out.write(shader)
+			a.out.close()
+		else:
+			print(shader)
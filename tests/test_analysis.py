@@ -0,0 +1,104 @@
+import os, sys, tempfile, unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from sloth import ShaderGenerator
+
+
+class ApproximateAverageTest(unittest.TestCase):
+	"Checks that approximate average colors of addition maps stay within the allowed error, also for maps whose "
+	"pattern lines up with a regular sampling grid."
+
+	size = 1024
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def save(self, img, name):
+		path = os.path.join(self.tempdir.name, name)
+		img.save(path)
+
+		return path
+
+
+	def assertWithinError(self, path, error):
+		exact  = ShaderGenerator.analyzeAdditionMap(path, True)["additionAverage"]
+		approx = ShaderGenerator.analyzeAdditionMap(path, True, approx = error)["additionAverage"]
+
+		for exactChannel, approxChannel in zip(exact, approx):
+			self.assertLessEqual(abs(exactChannel - approxChannel), error, path)
+
+
+	def test_periodic_rows(self):
+		# every fourth row is orange, the others are black
+		img = Image.new("RGB", (self.size, self.size))
+
+		for row in range(0, self.size, 4):
+			img.paste((255, 160, 0), (0, row, self.size, row + 1))
+
+		for ext in ("tga", "png", "bmp", "jpg"):
+			self.assertWithinError(self.save(img, "stripes."+ext), 0.01)
+
+
+	def test_periodic_columns(self):
+		img = Image.new("RGB", (self.size, self.size))
+
+		for column in range(0, self.size, 8):
+			img.paste((0, 255, 255), (column, 0, column + 1, self.size))
+
+		for ext in ("tga", "png"):
+			self.assertWithinError(self.save(img, "columns."+ext), 0.01)
+
+
+	def test_single_row(self):
+		# a smooth gradient with a single red row
+		img = Image.linear_gradient("L").resize((self.size, self.size)).convert("RGB")
+		img.paste((255, 0, 0), (0, 500, self.size, 501))
+
+		for ext in ("tga", "png"):
+			self.assertWithinError(self.save(img, "row."+ext), 0.001)
+
+
+	def test_noise(self):
+		img = Image.merge("RGB", [Image.effect_noise((self.size, self.size), sigma) for sigma in (20, 40, 60)])
+
+		self.assertWithinError(self.save(img, "noise.tga"), 0.01)
+
+
+class MemoryEstimateTest(unittest.TestCase):
+	"Checks that tiled analysis only reduces the memory estimate of maps that can be decoded strip by strip."
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def test_compressed_maps_are_decoded_whole(self):
+		img  = Image.new("RGBA", (512, 512), (10, 20, 30, 255))
+		full = 512 * 512 * 4
+
+		for ext, tiled in (("tga", True), ("png", False)):
+			path     = os.path.join(self.tempdir.name, "map."+ext)
+			img.save(path)
+			fileSize = 4 * os.path.getsize(path)
+
+			estimate = ShaderGenerator.estimateMapMemory(path, 16) - fileSize
+			self.assertEqual(estimate < full, tiled, path)
+
+			# addition maps are converted to RGB strip by strip
+			converted = ShaderGenerator.estimateMapMemory(path, 16, True) - fileSize
+			self.assertEqual(converted - estimate, 512 * 16 * 4, path)
+
+
+if __name__ == "__main__":
+	unittest.main()
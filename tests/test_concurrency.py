@@ -0,0 +1,124 @@
+import os, sys, random, tempfile, threading, unittest, concurrent.futures
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from sloth import ShaderGenerator
+
+
+class ConcurrencyTest(unittest.TestCase):
+	"Generates many synthetic sets from many threads while shaders are being written, and compares the result with "
+	"a serial run."
+
+	numSets    = 40
+	numThreads = 16
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		rand         = random.Random(1)
+
+		for number in range(self.numSets):
+			path = os.path.join(self.tempdir.name, "textures", "set%02d_src" % number)
+			os.makedirs(path)
+
+			for shader in range(rand.randint(1, 6)):
+				name = os.path.join(path, "metal%d" % shader)
+				mode = rand.choice(("RGB", "RGBA", "L"))
+
+				if mode == "L":
+					color = rand.randint(0, 255)
+				else:
+					color = tuple(rand.randint(0, 255) for band in mode)
+
+				# make some alpha channels binary and some smooth
+				img = Image.new(mode, (16, 16), color)
+				if mode == "RGBA" and rand.random() < 0.5:
+					img.putpixel((0, 0), (0, 0, 0, 0))
+				img.save(name+"_d.tga")
+
+				if rand.random() < 0.5:
+					Image.new("RGB", (16, 16), (rand.randint(0, 255), 0, 0)).save(name+"_a.tga")
+				elif rand.random() < 0.5:
+					Image.new("L", (16, 16), rand.randint(0, 255)).save(name+"_a.tga")
+
+				if rand.random() < 0.5:
+					Image.new("RGB", (16, 16), (128, 128, 255)).save(name+"_n.tga")
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def makeGenerator(self):
+		sg = ShaderGenerator()
+
+		sg.setKeywordGuessing(True)
+		sg.setRenderer("daemon")
+		sg.addLightColor("red", "ff0000")
+		sg.addLightColor("white", "ffffff")
+		sg.addCustomLightIntensity(100)
+		sg.addPredefLightIntensity(200)
+
+		return sg
+
+
+	def pathList(self):
+		return [os.path.join(self.tempdir.name, "textures", name)
+		        for name in sorted(os.listdir(os.path.join(self.tempdir.name, "textures")))]
+
+
+	def test_concurrent_generation_matches_serial(self):
+		pathes = self.pathList()
+		serial = self.makeGenerator()
+
+		for path in pathes:
+			serial.generateSet(path)
+
+		expected = {setname: serial.getShader(setname = setname) for setname in serial.sets}
+
+		interval = sys.getswitchinterval()
+		sys.setswitchinterval(1e-6)
+
+		try:
+			sg     = self.makeGenerator()
+			done   = threading.Event()
+			errors = list()
+
+			# write shaders and set options to their current values while sets are being generated
+			def emit():
+				while not done.is_set():
+					try:
+						sg.getShader()
+						sg.getShader(compact = True)
+						sg.setRenderer("daemon")
+						sg.setSuffixes()
+					except Exception as error:
+						errors.append(error)
+						return
+
+			emitters = [threading.Thread(target = emit) for _ in range(4)]
+
+			for thread in emitters:
+				thread.start()
+
+			order = pathes[:]
+			random.Random(2).shuffle(order)
+
+			try:
+				with concurrent.futures.ThreadPoolExecutor(self.numThreads) as pool:
+					list(pool.map(sg.generateSet, order))
+			finally:
+				done.set()
+
+				for thread in emitters:
+					thread.join()
+		finally:
+			sys.setswitchinterval(interval)
+
+		self.assertEqual(errors, [])
+		self.assertEqual({setname: sg.getShader(setname = setname) for setname in sg.sets}, expected)
+
+
+if __name__ == "__main__":
+	unittest.main()
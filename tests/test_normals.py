@@ -0,0 +1,84 @@
+import os, sys, math, tempfile, unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+import sloth
+from sloth import ShaderGenerator
+
+
+class BakeNormalMapTest(unittest.TestCase):
+	"Checks that normal maps baked from 8 and 16 bit height maps agree, with and without NumPy."
+
+	size = 64
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+
+		# the same smooth waves as 8 and 16 bit height maps
+		waves = [0.5 + 0.5 * math.sin(x / 5) * math.cos(y / 7) for y in range(self.size) for x in range(self.size)]
+
+		self.height8 = Image.new("L", (self.size, self.size))
+		self.height8.putdata([round(value * 0xff) for value in waves])
+
+		self.height16 = Image.new("I;16", (self.size, self.size))
+		self.height16.putdata([round(value * 0xffff) for value in waves])
+
+		self.normal = Image.new("RGB", (self.size, self.size), (140, 120, 240))
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def path(self, name):
+		return os.path.join(self.tempdir.name, name)
+
+
+	def bake(self, height, normal, useNumpy):
+		numpy = sloth.numpy
+
+		if not useNumpy:
+			sloth.numpy = None
+
+		try:
+			target = self.path("baked_%s_%s_%d.png" % (os.path.basename(height), bool(normal), useNumpy))
+			ShaderGenerator.bakeNormalMap(height, normal, 4.0, target, "signature")
+		finally:
+			sloth.numpy = numpy
+
+		with Image.open(target) as img:
+			return list(img.getdata())
+
+
+	def assertClose(self, first, second, tolerance):
+		self.assertEqual(len(first), len(second))
+		self.assertLessEqual(max(abs(a - b) for p, q in zip(first, second) for a, b in zip(p, q)), tolerance)
+
+
+	def test_heights(self):
+		self.height8.save(self.path("h8.png"))
+		self.height16.save(self.path("h16.png"))
+
+		with Image.open(self.path("h16.png")) as img:
+			self.assertIn(img.mode, ShaderGenerator.deepModeRanges)
+
+		self.normal.save(self.path("n.png"))
+
+		for normal in (None, self.path("n.png")):
+			for useNumpy in ((False, True) if sloth.numpy else (False,)):
+				baked8  = self.bake(self.path("h8.png"), normal, useNumpy)
+				baked16 = self.bake(self.path("h16.png"), normal, useNumpy)
+
+				# 16 bit heights are scaled, not clipped, so they result in about the same normals
+				self.assertClose(baked8, baked16, 4)
+				self.assertGreater(len(set(baked16)), 100)
+
+			if sloth.numpy:
+				self.assertClose(self.bake(self.path("h16.png"), normal, False),
+				                 self.bake(self.path("h16.png"), normal, True), 1)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,85 @@
+import os, sys, time, tempfile, unittest, zipfile
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from sloth import ShaderGenerator
+
+
+class PackageTest(unittest.TestCase):
+	"Writes packages with the hand-written zip writer and checks them with zipfile, also when members are reused from "
+	"an earlier package and when maps are older than the first zip date in a time zone west of UTC."
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.source  = os.path.join(self.tempdir.name, "textures", "metal_src")
+		self.package = os.path.join(self.tempdir.name, "metal.pk3")
+
+		os.makedirs(self.source)
+
+		for number in range(3):
+			self.saveMap("plate%d_d.tga" % number, (40 * number, 80, 120))
+			self.saveMap("plate%d_n.png" % number, (128, 128, 255))
+
+		self.timezone = os.environ.get("TZ")
+		os.environ["TZ"] = "America/New_York"
+		time.tzset()
+
+
+	def tearDown(self):
+		if self.timezone == None:
+			del os.environ["TZ"]
+		else:
+			os.environ["TZ"] = self.timezone
+
+		time.tzset()
+		self.tempdir.cleanup()
+
+
+	def saveMap(self, name, color):
+		path = os.path.join(self.source, name)
+		Image.new("RGB", (16, 16), color).save(path)
+
+		# touched to the epoch, as done for reproducible builds
+		os.utime(path, (0, 0))
+
+
+	def writePackage(self):
+		sg = ShaderGenerator()
+		sg.generateSet(self.source)
+
+		reused = sg.writePackage(self.package)
+
+		with zipfile.ZipFile(self.package, "r") as archive:
+			self.assertIsNone(archive.testzip())
+
+			names = archive.namelist()
+			dates = {info.date_time for info in archive.infolist() if info.filename.endswith((".tga", ".png"))}
+
+		return names, dates, reused
+
+
+	@unittest.skipUnless(hasattr(time, "tzset"), "time zones can't be changed")
+	def test_reuse(self):
+		names, dates, reused = self.writePackage()
+
+		self.assertEqual(len(names), 7)
+		self.assertEqual(dates, {(1980, 1, 1, 0, 0, 0)})
+		self.assertEqual(reused, 0)
+
+		# change the content of a single map but keep its color, so that the shaders stay the same
+		with Image.open(os.path.join(self.source, "plate1_n.png")) as img:
+			img = img.copy()
+
+		img.putpixel((0, 0), (127, 128, 255))
+		img.save(os.path.join(self.source, "plate1_n.png"))
+
+		names, dates, reused = self.writePackage()
+
+		self.assertEqual(len(names), 7)
+		self.assertEqual(reused, 6)
+
+
+if __name__ == "__main__":
+	unittest.main()
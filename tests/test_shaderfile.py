@@ -0,0 +1,148 @@
+import os, sys, tempfile, unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from sloth import ShaderGenerator, ShaderFile
+
+
+class ShaderFileTest(unittest.TestCase):
+	"Checks parsing, adding and marking shader definitions, and merging generated shaders into a file."
+
+	text = \
+"""// header comment
+textures/metal/plate
+{
+	qer_editorImage textures/metal/plate_d // a { brace in a comment
+	{
+		map "textures/metal/plate_d"
+	}
+}
+
+/* block comment */
+textures/metal/wall
+{
+	diffuseMap textures/metal/wall_d
+}
+textures/wood/floor
+{
+	diffuseMap textures/wood/floor_d
+}
+"""
+
+	def test_round_trip(self):
+		shaderFile = ShaderFile(self.text)
+
+		self.assertEqual(shaderFile.getText(), self.text)
+		self.assertEqual(list(shaderFile.shaders), ["textures/metal/plate", "textures/metal/wall", "textures/wood/floor"])
+
+		for name, index in shaderFile.shaders.items():
+			self.assertEqual(shaderFile[index][0], name)
+			self.assertTrue(shaderFile[index][1].startswith(name+"\n{"))
+			self.assertTrue(shaderFile[index][1].endswith("}"))
+
+
+	def test_add(self):
+		shaderFile = ShaderFile(self.text)
+
+		shaderFile.add("textures/metal/grate", "textures/metal/grate\n{\n}\n")
+		shaderFile.add("textures/stone/block", "textures/stone/block\n{\n}\n")
+
+		# after the last shader with the same path, or at the end
+		self.assertEqual(list(name for name, _ in shaderFile if name),
+		                 ["textures/metal/plate", "textures/metal/wall", "textures/metal/grate", "textures/wood/floor",
+		                  "textures/stone/block"])
+
+		for name, index in shaderFile.shaders.items():
+			self.assertEqual(shaderFile[index][0], name)
+
+		self.assertEqual(ShaderFile(shaderFile.getText()).getText(), shaderFile.getText())
+
+
+	def test_stamp(self):
+		text   = "textures/metal/wall\n{\n\tdiffuseMap textures/metal/wall_d\n}"
+		digest = ShaderFile.digest(text)
+		marked = ShaderFile.stamp(text, digest)
+
+		self.assertNotEqual(marked, text)
+		self.assertEqual(ShaderFile.unstamp(marked), (digest, text))
+		self.assertEqual(ShaderFile.unstamp(text), (None, text))
+
+		# the mark survives parsing as part of the definition
+		shaderFile = ShaderFile(marked+"\n")
+		self.assertEqual(ShaderFile.unstamp(shaderFile[shaderFile.shaders["textures/metal/wall"]][1]), (digest, text))
+
+
+class MergeShaderTest(unittest.TestCase):
+	"Checks which definitions mergeShader replaces."
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.source  = os.path.join(self.tempdir.name, "textures", "metal_src")
+		os.makedirs(self.source)
+
+		for name in ("plate", "wall"):
+			Image.new("RGB", (8, 8)).save(os.path.join(self.source, name+"_d.tga"))
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def generate(self, alpha = False):
+		sg = ShaderGenerator()
+
+		# a smooth alpha channel changes the definition of the shader but doesn't add shaders
+		img = Image.new("RGBA" if alpha else "RGB", (8, 8))
+		if alpha:
+			img.putpixel((0, 0), (0, 0, 0, 128))
+		img.save(os.path.join(self.source, "plate_d.tga"))
+
+		sg.generateSet(self.source)
+
+		return sg
+
+
+	def piece(self, text, suffix):
+		shaderFile = ShaderFile(text)
+
+		return [text for name, text in shaderFile if name and name.endswith(suffix)][0]
+
+
+	def definition(self, text, suffix):
+		return ShaderFile.unstamp(self.piece(text, suffix))[1]
+
+
+	def test_unmarked_definitions(self):
+		# written without marks, such as by an earlier version
+		text = self.generate().getShader()
+
+		# definitions that don't change stay byte for byte intact
+		self.assertEqual(self.generate().mergeShader(ShaderFile(text)), text)
+
+		# changed definitions without a mark are only replaced when adopting them
+		self.assertEqual(self.generate(True).mergeShader(ShaderFile(text)), text)
+
+		merged = self.generate(True).mergeShader(ShaderFile(text), adopt = True)
+		self.assertNotEqual(self.definition(merged, "/plate"), self.definition(text, "/plate"))
+		self.assertEqual(self.piece(merged, "/wall"), self.piece(text, "/wall"))
+
+		# now marked, so later changes are merged without adopting
+		merged = self.generate().mergeShader(ShaderFile(merged))
+		self.assertEqual(self.definition(merged, "/plate"), self.definition(text, "/plate"))
+
+
+	def test_hand_edited_definitions(self):
+		merged = self.generate().mergeShader(ShaderFile())
+		plate  = self.piece(merged, "/plate")
+		edited = merged.replace(plate, plate.replace("{\n", "{\n\tsurfaceparm metalsteps\n", 1))
+
+		self.assertNotEqual(edited, merged)
+
+		for adopt in (False, True):
+			self.assertEqual(self.generate(True).mergeShader(ShaderFile(edited), adopt), edited)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,50 @@
+import os, sys, tempfile, unittest
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir))
+
+from sloth import ShaderGenerator
+
+
+class TranscodeMapTest(unittest.TestCase):
+	"Checks that 16 bit maps are scaled instead of clipped when transcoded, and stay 16 bit in PNG files."
+
+	values = [0, 10000, 20000, 40000, 65535]
+
+	def setUp(self):
+		self.tempdir = tempfile.TemporaryDirectory()
+		self.source  = os.path.join(self.tempdir.name, "height_h.png")
+
+		img = Image.new("I;16", (len(self.values), 1))
+		img.putdata(self.values)
+		img.save(self.source)
+
+
+	def tearDown(self):
+		self.tempdir.cleanup()
+
+
+	def transcode(self, format, lossless):
+		target = ShaderGenerator.transcodeMap(self.source, os.path.join(self.tempdir.name, "out", format), format,
+		                                      lossless, None, False, None)
+
+		with Image.open(target) as img:
+			return img.mode, list(img.getdata())
+
+
+	def test_png_keeps_16_bits(self):
+		mode, data = self.transcode("png", True)
+
+		self.assertEqual(mode, "I;16")
+		self.assertEqual(data, self.values)
+
+
+	def test_lossless_webp_is_scaled(self):
+		mode, data = self.transcode("webp", True)
+
+		self.assertEqual([rgb[0] for rgb in data], [round(value / 0x101) for value in self.values])
+
+
+if __name__ == "__main__":
+	unittest.main()